@@ -1,21 +1,37 @@
 import sqlite3
 import hashlib
+import hmac
+import base64
+import secrets
 import streamlit as st
 from streamlit import session_state as state
 from datetime import date, timedelta, datetime
 import time
+import queue
+import random
 import openai
-from openai import OpenAI, RateLimitError, OpenAIError
+from openai import OpenAI, RateLimitError, OpenAIError, APIConnectionError, APITimeoutError, InternalServerError
 import numpy as np
+import nutrition_targets
+import passwords
 from PIL import Image
 from io import BytesIO
 import json
+import re
+import unicodedata
 import requests
 from pathlib import Path
 import os
+import tempfile
+import threading
+from collections import defaultdict, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlparse
+import httpx
 from sqlalchemy import text
 from supabase import create_client, Client
-import bcrypt
+from postgrest.exceptions import APIError
 import pandas as pd
 import plotly.graph_objects as go
 import plotly.express as px
@@ -23,9 +39,466 @@ import plotly.express as px
 SUPABASE_URL = st.secrets["supabase"]["url"]
 SUPABASE_KEY = st.secrets["supabase"]["key"]
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# -------------------- Metrics --------------------
+@st.cache_resource
+def get_metrics():
+    """Process-wide counters shared by every session (cache hits, client rebuilds, ...)."""
+    return {"lock": threading.Lock(), "counters": defaultdict(int), "timings": defaultdict(list)}
+
+def bump_metric(name, amount=1, metrics=None):
+    metrics = metrics or get_metrics()
+    with metrics["lock"]:
+        metrics["counters"][name] += amount
+
+def record_timing(name, seconds, keep=200, metrics=None):
+    # Background threads pass in the metrics they were handed, they can't call get_metrics()
+    metrics = metrics or get_metrics()
+    with metrics["lock"]:
+        samples = metrics["timings"][name]
+        samples.append(seconds)
+        del samples[:-keep]
+
+# -------------------- Shared Clients --------------------
+# Streamlit re-executes this file on every interaction, so the Supabase and OpenAI
+# clients (and their keep-alive HTTP pools) are built once per server process.
+HTTP_POOL_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=60)
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+def _supabase_is_healthy(sb):
+    return not getattr(sb, "_bodari_broken", False)
+
+def _openai_is_healthy(oa):
+    return not getattr(oa, "_bodari_broken", False) and not oa._client.is_closed
+
+@st.cache_resource(validate=_supabase_is_healthy)
+def get_supabase() -> Client:
+    bump_metric("supabase_client_created")
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
+
+@st.cache_resource(validate=_openai_is_healthy)
+def get_openai_client() -> OpenAI:
+    bump_metric("openai_client_created")
+    http_client = httpx.Client(limits=HTTP_POOL_LIMITS, timeout=HTTP_TIMEOUT)
+    return OpenAI(api_key=st.secrets["openai"]["api_key"], http_client=http_client, max_retries=2)
+
+def mark_client_broken(shared_client, metrics=None):
+    """Flags a pooled client so the next rerun reconnects instead of reusing it."""
+    shared_client._bodari_broken = True
+    bump_metric("client_reconnects", metrics=metrics)
+
+def check_supabase_error(sb, e, metrics=None):
+    """A transport failure from PostgREST leaves the pooled session suspect, so rebuild it."""
+    if isinstance(e, httpx.TransportError):
+        mark_client_broken(sb, metrics)
+
+def _pool_connections(http_client):
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    return list(getattr(pool, "connections", []) or [])
+
+def client_pool_stats():
+    """Connection pool figures used to size the HTTP pools."""
+    oa = get_openai_client()
+    openai_conns = _pool_connections(oa._client)
+    sb = get_supabase()
+    postgrest_session = getattr(sb.postgrest, "session", None)
+    supabase_conns = _pool_connections(postgrest_session) if postgrest_session else []
+    return {
+        "openai_connections": len(openai_conns),
+        "openai_idle_connections": sum(1 for c in openai_conns if c.is_idle()),
+        "supabase_connections": len(supabase_conns),
+        "supabase_idle_connections": sum(1 for c in supabase_conns if c.is_idle()),
+        "max_connections": HTTP_POOL_LIMITS.max_connections,
+        "max_keepalive_connections": HTTP_POOL_LIMITS.max_keepalive_connections,
+        **dict(get_metrics()["counters"]),
+    }
+
+def render_diagnostics():
+    """Only shown when `debug = true` is set under [app] in the Streamlit secrets."""
+    if not st.secrets.get("app", {}).get("debug", False):
+        return
+    with st.expander("Diagnostics"):
+        st.json(client_pool_stats())
+        counters = dict(get_metrics()["counters"])
+        hit_rates = {name[:-len("_hits")]: round(hits / (hits + counters.get(name[:-len("_hits")] + "_misses", 0)), 3)
+                     for name, hits in counters.items() if name.endswith("_cache_hits")}
+        if hit_rates:
+            st.json({"hit_rates": hit_rates})
+        timings = {name: {"count": len(v), "avg_ms": round(1000 * sum(v) / len(v), 1)}
+                   for name, v in dict(get_metrics()["timings"]).items() if v}
+        if timings:
+            st.json(timings)
+
+supabase: Client = get_supabase()
+
+# -------------------- Local Cache --------------------
+# SQLite (WAL) copy of the user_meals, grocery_ingredients, weekly_meal_plan and
+# recipes reads the pages make on every rerun. Entries are query results keyed by
+# table and scope ("<user_id>:<week_start>", a recipe id, ...). Fresh entries are
+# served locally; stale ones are refetched, or served as they are while Supabase
+# is unreachable. Writes go upstream and mark the scopes they touch stale; when
+# Supabase is down they are queued in the same file and replayed in order.
+LOCAL_CACHE_PATH = Path(__file__).parent / "local_cache.sqlite3"
+LOCAL_CACHE_TTLS = {
+    "user_meals": 300, "grocery_ingredients": 300, "weekly_meal_plan": 600, "recipes": 24 * 3600,
+    "daily_nutrition_totals": 300,
+}
+LOCAL_REPLAY_INTERVAL = 30
+LOCAL_REPLAY_MAX_ATTEMPTS = 5
+LOCAL_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cached_rows (
+    tbl TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    data TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (tbl, scope)
+);
+CREATE TABLE IF NOT EXISTS pending_writes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tbl TEXT NOT NULL,
+    op TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+def is_upstream_outage(e):
+    """Connection failures and gateway errors, as opposed to Postgres rejecting the query."""
+    if isinstance(e, httpx.TransportError):
+        return True
+    return isinstance(e, APIError) and str(e.code) in {"500", "502", "503", "504"}
+
+def can_resend_write(op, e):
+    """Whether `op` may be sent again after failing with `e`.
+
+    Upserts, updates and deletes are idempotent, so any outage will do. An insert only
+    when the request provably never reached Supabase: after a read timeout it may well
+    have committed, and sending it again would save the meal or recipe twice.
+    """
+    if op["op"] == "insert":
+        return isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+    return is_upstream_outage(e)
+
+@st.cache_resource
+def get_local_cache():
+    # One connection shared by every session; the lock serializes access to it
+    conn = sqlite3.connect(str(LOCAL_CACHE_PATH), timeout=5, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(LOCAL_CACHE_SCHEMA)
+    return {"conn": conn, "lock": threading.Lock(), "replay_lock": threading.Lock(), "replayed_at": 0.0}
+
+def _local_get(cache, table, scopes):
+    """{scope: (rows, fetched_at)} for the scopes held locally."""
+    with cache["lock"]:
+        found = cache["conn"].execute(
+            f"SELECT scope, data, fetched_at FROM cached_rows WHERE tbl = ? AND scope IN ({','.join('?' * len(scopes))})",
+            (table, *scopes)
+        ).fetchall()
+    return {scope: (json.loads(data), fetched_at) for scope, data, fetched_at in found}
+
+def _local_put(cache, table, entries):
+    now = time.time()
+    with cache["lock"]:
+        cache["conn"].executemany(
+            "INSERT OR REPLACE INTO cached_rows (tbl, scope, data, fetched_at) VALUES (?, ?, ?, ?)",
+            [(table, scope, json.dumps(rows), now) for scope, rows in entries.items()]
+        )
+
+def local_rows(cache, table):
+    """Everything held locally for `table`, fresh or not."""
+    with cache["lock"]:
+        found = cache["conn"].execute("SELECT data FROM cached_rows WHERE tbl = ?", (table,)).fetchall()
+    return [json.loads(data) for data, in found]
+
+def invalidate_local(cache, table, scope_prefix=""):
+    """Marks every scope of `table` starting with `scope_prefix` stale (kept for outages)."""
+    with cache["lock"]:
+        cache["conn"].execute(
+            "UPDATE cached_rows SET fetched_at = 0 WHERE tbl = ? AND substr(scope, 1, ?) = ?",
+            (table, len(scope_prefix), scope_prefix)
+        )
+
+def cached_read_many(cache, table, scopes, fetch):
+    """Rows per scope. `fetch(scopes)` loads the missing or stale ones upstream and returns {scope: rows}."""
+    started = time.perf_counter()
+    scopes = [str(scope) for scope in scopes]
+    local = _local_get(cache, table, scopes) if scopes else {}
+    now = time.time()
+    result = {scope: rows for scope, (rows, fetched_at) in local.items() if now - fetched_at < LOCAL_CACHE_TTLS[table]}
+    stale = [scope for scope in scopes if scope not in result]
+    bump_metric("local_cache_hits", len(result))
+    if stale:
+        bump_metric("local_cache_misses", len(stale))
+        try:
+            fetched = {str(scope): rows for scope, rows in fetch(stale).items()}
+        except (httpx.TransportError, APIError) as e:
+            check_supabase_error(supabase, e)
+            if not is_upstream_outage(e) or not any(scope in local for scope in stale):
+                raise
+            bump_metric("local_cache_stale_served")
+            fetched = {scope: local[scope][0] for scope in stale if scope in local}
+        else:
+            _local_put(cache, table, fetched)
+        result.update(fetched)
+    else:
+        record_timing("local_cache_read", time.perf_counter() - started)
+    return result
+
+def cached_read(cache, table, scope, fetch):
+    """Rows of one query; `fetch()` runs it upstream when the local copy is missing or stale."""
+    return cached_read_many(cache, table, [scope], lambda stale: {stale[0]: fetch()}).get(str(scope), [])
+
+def _execute_write(sb, table, op):
+    query = sb.table(table)
+    if op["op"] == "insert":
+        query = query.insert(op["rows"])
+    elif op["op"] == "upsert":
+        query = query.upsert(op["rows"], on_conflict=op.get("on_conflict", ""))
+    elif op["op"] == "update":
+        query = query.update(op["values"])
+    else:
+        query = query.delete()
+    for column, value in op.get("match", {}).items():
+        query = query.eq(column, value)
+    return query.execute()
+
+def _queue_write(cache, table, op):
+    with cache["lock"]:
+        cache["conn"].execute("INSERT INTO pending_writes (tbl, op) VALUES (?, ?)", (table, json.dumps(op)))
+
+def has_pending_writes(cache, table=None):
+    with cache["lock"]:
+        if table is None:
+            return cache["conn"].execute("SELECT 1 FROM pending_writes LIMIT 1").fetchone() is not None
+        return cache["conn"].execute("SELECT 1 FROM pending_writes WHERE tbl = ? LIMIT 1", (table,)).fetchone() is not None
+
+def write_through(cache, sb, table, op, invalidate=(), attempts=1, metrics=None):
+    """Runs an insert/upsert/update/delete upstream and marks the `invalidate` (table, scope prefix) pairs stale.
+
+    Returns the response, or None when Supabase is down and the write was queued for
+    replay. Writes queue behind earlier pending ones for the same table so they land in
+    order. An insert that may have reached Supabase is neither retried nor queued (see
+    can_resend_write); its error is raised. Safe to call from worker threads, which pass
+    in their `metrics`.
+    """
+    op = {**op, "invalidate": [list(pair) for pair in invalidate]}
+    try:
+        if has_pending_writes(cache, table):
+            _queue_write(cache, table, op)
+            return None
+        for attempt in range(1, attempts + 1):
+            try:
+                return _execute_write(sb, table, op)
+            except (httpx.TransportError, APIError) as e:
+                check_supabase_error(sb, e, metrics)
+                if not can_resend_write(op, e):
+                    raise
+                if attempt == attempts:
+                    print(f"Supabase unreachable, queued {op['op']} on {table}: {e}")
+                    _queue_write(cache, table, op)
+                    return None
+                time.sleep(0.5 * 2 ** (attempt - 1))
+    finally:
+        for pair in invalidate:
+            invalidate_local(cache, *pair)
+
+def _after_replay(table, op):
+    # Follow-up work the original write would have triggered
+    if table == "user_meals":
+        for row in op["rows"] if isinstance(op["rows"], list) else [op["rows"]]:
+            refresh_daily_totals(row["user_id"], row["date"])
+    elif table == "grocery_ingredients" and op["rows"]:
+        refresh_grocery_needs(supabase, op["rows"][0]["user_id"], get_current_week_start().isoformat())
+
+def replay_pending_writes(cache, sb, force=False):
+    """Replays queued writes oldest first; stops at the first one Supabase still can't take."""
+    if not force and time.time() - cache["replayed_at"] < LOCAL_REPLAY_INTERVAL:
+        return
+    if not cache["replay_lock"].acquire(blocking=False):
+        return
+    try:
+        cache["replayed_at"] = time.time()
+        while True:
+            with cache["lock"]:
+                pending = cache["conn"].execute(
+                    "SELECT id, tbl, op, attempts FROM pending_writes ORDER BY id LIMIT 1"
+                ).fetchone()
+            if pending is None:
+                return
+            write_id, table, op, attempts = pending
+            op = json.loads(op)
+            try:
+                _execute_write(sb, table, op)
+            except (httpx.TransportError, APIError) as e:
+                check_supabase_error(sb, e)
+                if can_resend_write(op, e):
+                    return
+                if is_upstream_outage(e):
+                    # An insert that may have landed: dropping it beats saving it twice
+                    print(f"Dropping queued insert on {table}, it may have been applied: {e}")
+                    bump_metric("local_replay_dropped")
+                elif attempts + 1 < LOCAL_REPLAY_MAX_ATTEMPTS:
+                    with cache["lock"]:
+                        cache["conn"].execute("UPDATE pending_writes SET attempts = attempts + 1 WHERE id = ?", (write_id,))
+                    return
+                else:
+                    print(f"Dropping queued {op['op']} on {table} after {LOCAL_REPLAY_MAX_ATTEMPTS} attempts: {e}")
+                    bump_metric("local_replay_dropped")
+            else:
+                bump_metric("local_replay_applied")
+                for pair in op.get("invalidate", []):
+                    invalidate_local(cache, *pair)
+                try:
+                    _after_replay(table, op)
+                except Exception as e:
+                    print(f"Follow-up after replaying {table} failed: {e}")
+            with cache["lock"]:
+                cache["conn"].execute("DELETE FROM pending_writes WHERE id = ?", (write_id,))
+    finally:
+        cache["replay_lock"].release()
+
+# -------------------- Ingredient Names --------------------
+# Pantry, grocery, recipe and meal names all resolve through one canonical index:
+# explicit aliases, then a descriptor-free and singularized key, then trigram
+# similarity against the known vocabulary. Similarity only corrects typos: the
+# candidate must have the same words, each at most a letter or two off, so
+# "potato chips" never becomes "potato". Keys are accent-folded and singular and
+# only used for matching; what comes back is a display name with its accents and
+# plurals intact. Resolutions are memoized.
+COMMON_INGREDIENTS = [
+    "Eggs", "Milk", "Cheese", "Bread", "Spinach", "Chicken Breast", "Rice", "Oats",
+    "Banana", "Apple", "Tomato", "Carrot", "Potato", "Yogurt", "Beans", "Lentils", "Broccoli"
+]
+INGREDIENT_ALIASES = {
+    "egg": "eggs", "yoghurt": "yogurt", "greek yogurt": "yogurt", "greek yoghurt": "yogurt", "chicken": "chicken breast",
+    "chicken fillet": "chicken breast", "kidney beans": "beans", "black beans": "beans",
+    "white rice": "rice", "brown rice": "rice", "rolled oats": "oats", "oatmeal": "oats",
+    "evoo": "olive oil", "extra virgin olive oil": "olive oil", "spaghetti": "pasta", "penne": "pasta",
+}
+INGREDIENT_DESCRIPTORS = {
+    "fresh", "raw", "organic", "fillet", "fillets", "boneless", "skinless", "chopped", "sliced",
+    "diced", "cooked", "large", "medium", "small", "whole", "frozen", "of",
+}
+INGREDIENT_MATCH_THRESHOLD = 0.6
+INGREDIENT_MEMO_ENTRIES = 50000
+INGREDIENT_LEARNED_ENTRIES = 20000  # names outside the vocabulary remembered as canonical
+
+def _clean_ingredient_name(name):
+    """Lowercased letters only, accents kept: 'Crème Fraîche (fresh)' -> 'crème fraîche'."""
+    text = unicodedata.normalize("NFC", str(name)).lower()
+    words = re.sub(r"[\W\d_]+", " ", text).split()
+    return " ".join(w for w in words if w not in INGREDIENT_DESCRIPTORS)
+
+def _fold_accents(text):
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+def _singular(word):
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("oes", "ches", "shes", "xes", "sses")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+def _ingredient_key(cleaned):
+    return " ".join(_singular(w) for w in _fold_accents(cleaned).split())
+
+def _trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def add_canonical_ingredient(index, name):
+    """Registers a display name under its key; the caller holds index["lock"] once the index is shared."""
+    cleaned = _clean_ingredient_name(name)
+    key = _ingredient_key(cleaned)
+    if not key or key in index["keys"]:
+        return
+    index["keys"][key] = cleaned
+    grams = _trigrams(key)
+    index["trigram_counts"][key] = len(grams)
+    for gram in grams:
+        index["trigrams"][gram].add(key)
+
+@st.cache_resource
+def get_ingredient_index():
+    index = {"lock": threading.Lock(), "keys": {}, "trigrams": defaultdict(set), "trigram_counts": {}, "memo": {}}
+    for name in [*NUTRITION_SEED, *COMMON_INGREDIENTS, *INGREDIENT_ALIASES.values()]:
+        add_canonical_ingredient(index, name)
+    return index
+
+def _edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+def _is_typo_of(key, candidate):
+    """Same words in the same order, each within one edit (two for words over six letters)."""
+    words, candidate_words = key.split(), candidate.split()
+    if len(words) != len(candidate_words):
+        return False
+    return all(w == c or _edit_distance(w, c) <= (2 if len(c) > 6 else 1)
+               for w, c in zip(words, candidate_words))
+
+def _closest_ingredient(index, key):
+    grams = _trigrams(key)
+    shared = defaultdict(int)
+    for gram in grams:
+        for candidate in index["trigrams"].get(gram, ()):
+            shared[candidate] += 1
+    scored = sorted(
+        ((2 * overlap / (len(grams) + index["trigram_counts"][candidate]), candidate)  # Dice coefficient
+         for candidate, overlap in shared.items()),
+        reverse=True
+    )
+    for score, candidate in scored:
+        if score < INGREDIENT_MATCH_THRESHOLD:
+            break
+        if _is_typo_of(key, candidate):
+            return candidate
+    return None
+
+def canonical_ingredient(name):
+    """'Chicken Breast fillet' -> 'chicken breast', 'Tomatoes' -> 'tomato', 'brocoli' -> 'broccoli'.
+
+    Names that match nothing known come back cleaned ('Hummus' -> 'hummus',
+    'Jamón Serrano' -> 'jamón serrano') and are remembered, so a later 'chicken thigh'
+    resolves to the 'chicken thighs' seen first.
+    """
+    index = get_ingredient_index()
+    memo = index["memo"]
+    if name in memo:
+        return memo[name]
+    cleaned = _clean_ingredient_name(name)
+    cleaned = INGREDIENT_ALIASES.get(_fold_accents(cleaned), cleaned)
+    key = _ingredient_key(cleaned)
+    with index["lock"]:
+        if key in index["keys"]:
+            canonical = index["keys"][key]
+        else:
+            closest = _closest_ingredient(index, key) if key else None
+            canonical = index["keys"][closest] if closest else cleaned
+            if not closest and len(index["keys"]) < INGREDIENT_LEARNED_ENTRIES:
+                add_canonical_ingredient(index, cleaned)
+        if len(memo) >= INGREDIENT_MEMO_ENTRIES:
+            memo.clear()
+        memo[name] = canonical
+    return canonical
 
 # -------------------- Recipes Functions --------------------
+RECIPE_CARD_COLUMNS = "id, title, image_url, diet, ingredients, calories, macros, instructions"
+RECIPE_PAGE_SIZE = 12
+
+def recipe_terms(row):
+    """Diet tags and canonical ingredient names of a recipes row, whose diet and
+    ingredients may be JSON text."""
+    diet = row["diet"] if isinstance(row.get("diet"), list) else json.loads(row.get("diet") or "[]")
+    ingredients = row["ingredients"] if isinstance(row.get("ingredients"), dict) else json.loads(row.get("ingredients") or "{}")
+    return sorted({d for d in diet if d != "None"}), sorted({canonical_ingredient(k) for k in ingredients})
+
 def insert_recipe(recipe):
     data = {
         "title": recipe['title'],
@@ -34,100 +507,1430 @@ def insert_recipe(recipe):
         "ingredients": json.dumps(recipe['ingredients']),
         "calories": recipe['calories'],
         "macros": json.dumps(recipe['macros']),
-        "instructions": recipe['instructions']
+        "instructions": recipe['instructions'],
     }
-    res = supabase.table("recipes").insert(data).execute()
-    st.write(dir(res))
-    if getattr(res, "status_code", None) != 201:
+    res = write_through(get_local_cache(), supabase, "recipes", {"op": "insert", "rows": data})
+    if res is None:
+        return None  # queued; sync_recipe_index picks it up once replayed
+    if not res.data:
         raise Exception(f"Failed to insert recipe: {res}")
+    index = get_recipe_index()
+    with index["lock"]:
+        add_recipe_to_index(index, res.data[0])
+    return res.data[0]
+
+def recipe_from_row(row):
+    return {
+        "id": row.get("id"),
+        "title": row["title"],
+        "image": row["image_url"],
+        "diet": json.loads(row["diet"]) if row.get("diet") else [],
+        "ingredients": row["ingredients"] if isinstance(row["ingredients"], dict) else json.loads(row["ingredients"]),
+        "calories": row["calories"],
+        "macros": row["macros"] if isinstance(row["macros"], dict) else json.loads(row["macros"]),
+        "instructions": row["instructions"]
+    }
+
+def _fetch_recipe_rows(ids):
+    res = supabase.table("recipes").select(RECIPE_CARD_COLUMNS).in_("id", [int(i) for i in ids]).execute()
+    return {row["id"]: row for row in res.data or []}
+
+def fetch_recipe_cards(ids):
+    """Card data for the given recipe ids, in the order given."""
+    if not ids:
+        return []
+    rows = cached_read_many(get_local_cache(), "recipes", ids, _fetch_recipe_rows)
+    return [recipe_from_row(rows[str(i)]) for i in ids if str(i) in rows]
+
+# -------------------- Recipe Index --------------------
+# Search runs against an in-process inverted index instead of Postgres: posting lists
+# for ingredient -> recipes and diet -> recipes, plus sorted arrays of calories and
+# macros for range filters. Queries combine them as NumPy boolean masks. The index
+# is loaded once per process and then follows the table by id: insert_recipe adds its
+# row right away and rows inserted by other processes are picked up every minute.
+# Diet and ingredient terms come from each row's diet and ingredients (recipe_terms).
+RECIPE_INDEX_COLUMNS = "id, diet, ingredients, calories, macros"
+RECIPE_INDEX_SYNC_SECONDS = 60
+RECIPE_INDEX_PAGE_SIZE = 1000
+# Ids are allocated before commit, so a lower id can land after a higher one has
+# synced; each sync re-reads this many ids below the newest it has seen.
+RECIPE_INDEX_RESCAN_IDS = 200
+RECIPE_RANGE_FIELDS = ('calories', 'protein', 'fat', 'carbs')
+
+@st.cache_resource
+def get_recipe_index():
+    index = {
+        "lock": threading.Lock(), "ids": [], "position": {},
+        "ingredients": defaultdict(list), "diets": defaultdict(list),
+        "values": {field: [] for field in RECIPE_RANGE_FIELDS}, "ingredient_counts": [],
+        "max_id": 0, "synced_at": 0.0, "arrays": None,
+    }
+    sync_recipe_index(index)
+    return index
+
+def add_recipe_to_index(index, row, track_max=True):
+    """Appends one recipes row; the caller holds index["lock"].
+
+    Rows seeded from the local cache pass track_max=False so the next sync still
+    fetches every id it hasn't seen.
+    """
+    if row["id"] in index["position"]:
+        return
+    pos = len(index["ids"])
+    index["ids"].append(row["id"])
+    index["position"][row["id"]] = pos
+
+    diets, ingredients = recipe_terms(row)
+    for tag in diets:
+        index["diets"][tag].append(pos)
+    for key in ingredients:
+        index["ingredients"][key].append(pos)
+    index["ingredient_counts"].append(len(ingredients))
+
+    macros = row["macros"] if isinstance(row.get("macros"), dict) else json.loads(row.get("macros") or "{}")
+    index["values"]["calories"].append(float(row.get("calories") or 0))
+    for field in ('protein', 'fat', 'carbs'):
+        index["values"][field].append(float(macros.get(field) or 0))
+    if track_max:
+        index["max_id"] = max(index["max_id"], row["id"])
+    index["arrays"] = None
+
+def sync_recipe_index(index):
+    """Adds every recipe with an id above the newest one already indexed, re-reading
+    the last RECIPE_INDEX_RESCAN_IDS ids for rows that committed late.
+
+    While Supabase is down the index keeps what it has; an empty one is seeded from
+    the recipe cards in the local cache.
+    """
+    after = max(0, index["max_id"] - RECIPE_INDEX_RESCAN_IDS)
+    try:
+        while True:
+            res = supabase.table("recipes") \
+                .select(RECIPE_INDEX_COLUMNS) \
+                .gt("id", after) \
+                .order("id") \
+                .limit(RECIPE_INDEX_PAGE_SIZE) \
+                .execute()
+            rows = res.data or []
+            with index["lock"]:
+                for row in rows:
+                    add_recipe_to_index(index, row)  # rows already indexed are skipped
+            if len(rows) < RECIPE_INDEX_PAGE_SIZE:
+                break
+            after = rows[-1]["id"]
+    except (httpx.TransportError, APIError) as e:
+        check_supabase_error(supabase, e)
+        if not is_upstream_outage(e):
+            raise
+        print(f"Recipe index sync failed, serving the rows already indexed: {e}")
+        if not index["ids"]:
+            with index["lock"]:
+                for row in local_rows(get_local_cache(), "recipes"):
+                    add_recipe_to_index(index, row, track_max=False)
+    index["synced_at"] = time.time()
+
+def _recipe_index_arrays(index):
+    """NumPy views of the index, rebuilt only after rows were added."""
+    if index["arrays"] is None:
+        values = {field: np.asarray(v, dtype=float) for field, v in index["values"].items()}
+        order = {field: np.argsort(v, kind="stable") for field, v in values.items()}
+        index["arrays"] = {
+            "ids": np.asarray(index["ids"], dtype=np.int64),
+            "order": order,
+            "sorted": {field: values[field][order[field]] for field in values},
+            "ingredient_counts": np.asarray(index["ingredient_counts"], dtype=float),
+            "postings": {},
+        }
+    return index["arrays"]
+
+def _postings(index, arrays, table, term):
+    cache_key = (table, term)
+    if cache_key not in arrays["postings"]:
+        arrays["postings"][cache_key] = np.asarray(index[table].get(term, ()), dtype=np.int64)
+    return arrays["postings"][cache_key]
+
+def _term_mask(index, arrays, table, term):
+    mask = np.zeros(len(arrays["ids"]), dtype=bool)
+    mask[_postings(index, arrays, table, term)] = True
+    return mask
+
+def _range_mask(arrays, field, low, high):
+    mask = np.zeros(len(arrays["ids"]), dtype=bool)
+    lo = np.searchsorted(arrays["sorted"][field], low, side="left")
+    hi = np.searchsorted(arrays["sorted"][field], high, side="right")
+    mask[arrays["order"][field][lo:hi]] = True
+    return mask
+
+def _pantry_coverage(index, arrays, pantry):
+    """Per recipe: how many of its ingredients are in the pantry, and what share that is."""
+    on_hand = np.zeros(len(arrays["ids"]), dtype=float)
+    for ingredient in {canonical_ingredient(i) for i in pantry}:
+        on_hand[_postings(index, arrays, "ingredients", ingredient)] += 1
+    return on_hand, on_hand / np.maximum(arrays["ingredient_counts"], 1)
+
+def search_recipe_index(all_ingredients=(), any_ingredients=(), diets=(), ranges=None, pantry=None, min_coverage=0.0):
+    """Recipe ids matching every filter.
+
+    `ranges` maps calories/protein/fat/carbs to (low, high). With a `pantry` (ingredient
+    names), recipes are scored by the share of their ingredients on hand, filtered by
+    `min_coverage` and returned best-covered first; otherwise in id order.
+    """
+    index = get_recipe_index()
+    if time.time() - index["synced_at"] > RECIPE_INDEX_SYNC_SECONDS:
+        sync_recipe_index(index)
+
+    with index["lock"]:
+        arrays = _recipe_index_arrays(index)
+        mask = np.ones(len(arrays["ids"]), dtype=bool)
+        for ingredient in all_ingredients:
+            mask &= _term_mask(index, arrays, "ingredients", canonical_ingredient(ingredient))
+        if any_ingredients:
+            either = np.zeros_like(mask)
+            for ingredient in any_ingredients:
+                either |= _term_mask(index, arrays, "ingredients", canonical_ingredient(ingredient))
+            mask &= either
+        diets = [d for d in diets if d != "None"]
+        if diets:
+            either = np.zeros_like(mask)
+            for diet in diets:
+                either |= _term_mask(index, arrays, "diets", diet)
+            mask &= either
+        for field, (low, high) in (ranges or {}).items():
+            mask &= _range_mask(arrays, field, low, high)
+
+        if pantry is None:
+            return arrays["ids"][np.flatnonzero(mask)].tolist()
+
+        on_hand, coverage = _pantry_coverage(index, arrays, pantry)
+        hits = np.flatnonzero(mask & (coverage >= min_coverage) & (on_hand > 0))
+        hits = hits[np.argsort(-coverage[hits], kind="stable")]
+        return arrays["ids"][hits].tolist()
+
+# -------------------- Recipe Recommendations --------------------
+# Ranks every indexed recipe by how well it fills what is left of today's targets and
+# how much of it the pantry already covers, without a model call.
+RECOMMENDATION_COUNT = 3
+RECOMMENDATION_PANTRY_WEIGHT = 0.5
+RECOMMENDATION_OVERSHOOT_PENALTY = 2.0
+
+def todays_remaining(user_id):
+    """Calories and macros left for today, or None without a profile."""
+    profile = get_session_profile(user_id)
+    if not profile:
+        return None
+    daily_calories, macros = profile.daily_calories, profile.macros
+    consumed = get_daily_totals(user_id, date.today().isoformat())
+    return {
+        'calories': max(daily_calories - consumed['calories'], 0),
+        'protein': max(macros['protein'] - consumed['protein'], 0),
+        'fat': max(macros['fat'] - consumed['fat'], 0),
+        'carbs': max(macros['carbs'] - consumed['carbs'], 0)
+    }
+
+@st.cache_data(ttl=3600, max_entries=1000, show_spinner=False)
+def recommend_recipes(user_id, day, pantry_fingerprint, _pantry, remaining, diets=(), k=RECOMMENDATION_COUNT):
+    """Top-k recipe ids for the remaining (calories, protein, fat, carbs) of `day`.
+
+    Only recipes tagged with every one of `diets` (the user's restrictions) qualify.
+    Cached per user, day and pantry fingerprint (plus the remaining targets, which
+    change whenever a meal is logged); `_pantry` is left out of the key.
+    """
+    index = get_recipe_index()
+    with index["lock"]:
+        arrays = _recipe_index_arrays(index)
+        if not len(arrays["ids"]):
+            return []
+        matrix = np.column_stack([index["values"][field] for field in RECIPE_RANGE_FIELDS])
+        target = np.asarray(remaining, dtype=float)
+        # Relative gap per nutrient; going over what's left counts double
+        gap = (matrix - target) / np.maximum(target, 1.0)
+        gap = np.where(gap > 0, gap * RECOMMENDATION_OVERSHOOT_PENALTY, gap)
+        distance = np.sqrt((gap ** 2).mean(axis=1))
+        _, coverage = _pantry_coverage(index, arrays, _pantry)
+        score = distance - RECOMMENDATION_PANTRY_WEIGHT * coverage
+
+        eligible = np.ones(len(score), dtype=bool)
+        for diet in diets:
+            if diet != "None":
+                eligible &= _term_mask(index, arrays, "diets", diet)
+        score = np.where(eligible, score, np.inf)
+        k = min(k, int(eligible.sum()))
+        if k == 0:
+            return []
+        top = np.argpartition(score, k - 1)[:k]
+        top = top[np.argsort(score[top], kind="stable")]
+        return arrays["ids"][top].tolist()
+
+# -------------------- Recipe Image Cache --------------------
+# Recipe cards only need a small thumbnail. Each image is fetched once, shrunk, and
+# written to IMAGE_CACHE_DIR under the sha256 of its source; warm reruns are served
+# from an in-process LRU or the disk copy without touching the network.
+# Uploaded images are saved under the sha256 of their bytes, so for them the source
+# (and with it every cache entry) is addressed by content.
+IMAGE_CACHE_DIR = Path(__file__).parent / "image_cache"
+IMAGE_CACHE_MAX_BYTES = 200 * 1024 * 1024
+IMAGE_CACHE_EVICT_TO = 0.9  # headroom so the writes right after an eviction don't trigger another
+THUMBNAIL_SIZE = (320, 320)
+IMAGE_FETCH_TIMEOUT = (3.05, 10)
+
+def _thumbnail_path(source):
+    digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    return IMAGE_CACHE_DIR / digest[:2] / f"{digest}.jpg"
+
+def make_thumbnail(image_bytes):
+    img = Image.open(BytesIO(image_bytes))
+    img.draft("RGB", THUMBNAIL_SIZE)  # lets JPEG decode at reduced scale
+    img = img.convert("RGB")
+    img.thumbnail(THUMBNAIL_SIZE)
+    out = BytesIO()
+    img.save(out, format="JPEG", quality=85, optimize=True)
+    return out.getvalue()
+
+def _image_cache_files():
+    files = []
+    for f in IMAGE_CACHE_DIR.glob("*/*.jpg"):
+        try:
+            files.append((f.stat(), f))
+        except FileNotFoundError:  # evicted or replaced by another session meanwhile
+            continue
+    return files
+
+def _evict_image_cache(target):
+    """Drops least recently used thumbnails until the cache fits `target` bytes; returns the new total."""
+    files = _image_cache_files()
+    total = sum(st_.st_size for st_, _ in files)
+    for st_, f in sorted(files, key=lambda item: item[0].st_mtime):
+        if total <= target:
+            break
+        f.unlink(missing_ok=True)
+        total -= st_.st_size
+    return total
+
+def store_thumbnail(source, image_bytes, loader):
+    """Writes the thumbnail to disk. The directory is only rescanned when the running total says it is full."""
+    thumb = make_thumbnail(image_bytes)
+    path = _thumbnail_path(source)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(thumb)
+    os.replace(tmp, path)
+    with loader["disk_lock"]:
+        if loader["disk_bytes"] is None:
+            loader["disk_bytes"] = sum(st_.st_size for st_, _ in _image_cache_files())
+        else:
+            loader["disk_bytes"] += len(thumb)  # overwrites overcount until the next scan
+        if loader["disk_bytes"] > IMAGE_CACHE_MAX_BYTES:
+            loader["disk_bytes"] = _evict_image_cache(int(IMAGE_CACHE_MAX_BYTES * IMAGE_CACHE_EVICT_TO))
+    return thumb
+
+def fetch_image_bytes(source):
+    if os.path.exists(source):
+        return Path(source).read_bytes()
+    res = requests.get(source, timeout=IMAGE_FETCH_TIMEOUT)
+    res.raise_for_status()
+    return res.content
+
+# Downloads for one page of cards run concurrently. At most IMAGE_FETCH_PER_HOST
+# downloads per host are handed to the pool; the rest wait in a per-host queue
+# outside it, so one slow image host can't take every worker.
+IMAGE_FETCH_WORKERS = 16
+IMAGE_FETCH_PER_HOST = 4
+IMAGE_PAGE_TIMEOUT = 20
+IMAGE_MEMORY_ENTRIES = 500
+
+@st.cache_resource
+def get_image_loader():
+    return {
+        "pool": ThreadPoolExecutor(max_workers=IMAGE_FETCH_WORKERS, thread_name_prefix="recipe-images"),
+        "lock": threading.Lock(),
+        "memory": OrderedDict(),
+        "host_active": defaultdict(int),
+        "host_waiting": defaultdict(deque),
+        "disk_lock": threading.Lock(),
+        "disk_bytes": None,  # bytes in IMAGE_CACHE_DIR, scanned on first write
+    }
+
+def load_thumbnail(loader, source):
+    """Thumbnail bytes for a recipe image path or URL plus where they came from.
+
+    Safe to call from worker threads: it makes no Streamlit calls.
+    """
+    with loader["lock"]:
+        if source in loader["memory"]:
+            loader["memory"].move_to_end(source)
+            return loader["memory"][source], "memory"
+    path = _thumbnail_path(source)
+    if path.exists():
+        os.utime(path)  # LRU bookkeeping for _evict_image_cache
+        thumb, origin = path.read_bytes(), "disk"
+    else:
+        thumb, origin = store_thumbnail(source, fetch_image_bytes(source), loader), "network"
+    with loader["lock"]:
+        loader["memory"][source] = thumb
+        while len(loader["memory"]) > IMAGE_MEMORY_ENTRIES:
+            loader["memory"].popitem(last=False)
+    return thumb, origin
+
+def _start_host_jobs(loader, host):
+    started = []
+    with loader["lock"]:
+        waiting = loader["host_waiting"][host]
+        while waiting and loader["host_active"][host] < IMAGE_FETCH_PER_HOST:
+            source, result = waiting.popleft()
+            if result.set_running_or_notify_cancel():  # skip pages that already gave up
+                loader["host_active"][host] += 1
+                started.append((source, result))
+    for source, result in started:
+        job = loader["pool"].submit(load_thumbnail, loader, source)
+        job.add_done_callback(lambda job, result=result: _host_job_done(loader, host, result, job))
+
+def _host_job_done(loader, host, result, job):
+    with loader["lock"]:
+        loader["host_active"][host] -= 1
+    if job.exception() is not None:
+        result.set_exception(job.exception())
+    else:
+        result.set_result(job.result())
+    _start_host_jobs(loader, host)
+
+def submit_thumbnail(loader, source):
+    """Future for load_thumbnail(loader, source); downloads wait for a slot of their host first."""
+    host = urlparse(source).netloc
+    if not host or _thumbnail_path(source).exists():
+        return loader["pool"].submit(load_thumbnail, loader, source)  # no download involved
+    result = Future()
+    with loader["lock"]:
+        loader["host_waiting"][host].append((source, result))
+    _start_host_jobs(loader, host)
+    return result
+
+def fill_recipe_images(slots, started):
+    """Fills each (source, st.empty) slot as its thumbnail becomes available."""
+    loader = get_image_loader()
+    futures = {}
+    for source, slot in slots:
+        if source:
+            futures[submit_thumbnail(loader, source)] = slot
+        else:
+            slot.warning("Image could not be loaded.")
+    try:
+        for future in as_completed(futures, timeout=IMAGE_PAGE_TIMEOUT):
+            slot = futures.pop(future)
+            try:
+                thumb, origin = future.result()
+                bump_metric(f"image_cache_{origin}")
+                slot.image(thumb, use_column_width=True)
+            except Exception:
+                slot.warning("Image could not be loaded.")
+    except FuturesTimeout:
+        for future, slot in futures.items():
+            future.cancel()
+            slot.warning("Image could not be loaded.")
+    record_timing("recipes_last_image", time.perf_counter() - started)
 
-def get_all_recipes():
-    res = supabase.table("recipes").select("*").execute()
-    recipes = []
-    for row in res.data:
-        recipes.append({
-            "title": row["title"],
-            "image": row["image_url"],
-            "diet": json.loads(row["diet"]) if row.get("diet") else [],
-            "ingredients": row["ingredients"] if isinstance(row["ingredients"], dict) else json.loads(row["ingredients"]),
-            "calories": row["calories"],
-            "macros": row["macros"] if isinstance(row["macros"], dict) else json.loads(row["macros"]),
-            "instructions": row["instructions"]
-        })
-    return recipes
-        
 # -------------------- Open AI --------------------
 openai.api_key = st.secrets["openai"]["api_key"]
-client = OpenAI(api_key=openai.api_key)
+client = get_openai_client()
+
+# -------------------- Meal Plan Schema --------------------
+# Plans are generated as JSON in JSON mode and stored in weekly_meal_plan.plan_data:
+#   {"days": [{"day": "Monday", "meals": [{"meal": "Breakfast", "name": "...",
+#     "ingredients": [{"name": "oats", "grams": 60}],
+#     "macros": {"protein": 0, "fat": 0, "carbs": 0, "calories": 0}}]}]}
+# meal_plan keeps the markdown rendering, and every planned ingredient also gets a row
+# in meal_plan_ingredients (user_id, week_start, day, meal, ingredient, grams).
+MEAL_PLAN_MODEL = "gpt-4o"
+MEAL_PLAN_SCHEMA_VERSION = 2
+WEEK_DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+PLAN_MEALS = ["Breakfast", "Snack 1", "Lunch", "Snack 2", "Dinner"]
+MEAL_PLAN_JSON_INSTRUCTIONS = """
+Respond with a single JSON object and nothing else, shaped exactly like this:
+{"days": [{"day": "Monday", "meals": [{"meal": "Breakfast", "name": "Oatmeal with banana",
+  "ingredients": [{"name": "oats", "grams": 60}, {"name": "banana", "grams": 120}],
+  "macros": {"protein": 12, "fat": 6, "carbs": 70, "calories": 380}}]}]}
+Include all seven days (Monday to Sunday), each with the meals Breakfast, Snack 1, Lunch, Snack 2 and Dinner.
+Ingredient names are plain lowercase food names; every quantity is in grams.
+"""
+
+def validate_plan_day(day):
+    """Checks and normalizes one day of a generated plan; raises ValueError when it doesn't fit the schema."""
+    if not isinstance(day, dict) or day.get("day") not in WEEK_DAYS or not isinstance(day.get("meals"), list):
+        raise ValueError(f"Invalid day in meal plan: {day.get('day') if isinstance(day, dict) else day!r}")
+    meals = []
+    for meal in day["meals"]:
+        try:
+            meals.append({
+                "meal": str(meal["meal"]),
+                "name": str(meal.get("name", "")),
+                "ingredients": [
+                    {"name": str(i["name"]).strip().lower(), "grams": float(i["grams"])}
+                    for i in meal["ingredients"]
+                ],
+                "macros": {k: float((meal.get("macros") or {}).get(k, 0) or 0) for k in ('protein', 'fat', 'carbs', 'calories')},
+            })
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            raise ValueError(f"Invalid meal on {day['day']}: {e}") from e
+    return {"day": day["day"], "meals": meals}
+
+def validate_meal_plan(data):
+    """Checks and normalizes a generated plan; raises ValueError when it doesn't fit the schema."""
+    if not isinstance(data, dict) or not isinstance(data.get("days"), list):
+        raise ValueError("Meal plan must be an object with a 'days' list.")
+    days = [validate_plan_day(day) for day in data["days"]]
+    if [d["day"] for d in days] != WEEK_DAYS:
+        raise ValueError("Meal plan must cover Monday to Sunday in order.")
+    return {"days": days}
+
+def render_meal_plan_markdown(plan):
+    """Markdown table with one row per day and one column per meal."""
+    meal_names = [m for m in PLAN_MEALS if any(meal["meal"] == m for d in plan["days"] for meal in d["meals"])]
+    for d in plan["days"]:
+        meal_names += [meal["meal"] for meal in d["meals"] if meal["meal"] not in meal_names]
+    lines = ["| Day | " + " | ".join(meal_names) + " |", "|---" * (len(meal_names) + 1) + "|"]
+    for d in plan["days"]:
+        cells = []
+        by_meal = {meal["meal"]: meal for meal in d["meals"]}
+        for m in meal_names:
+            meal = by_meal.get(m)
+            if not meal:
+                cells.append("")
+                continue
+            ingredients = ", ".join(f"{i['name']} ({i['grams']:g}g)" for i in meal["ingredients"])
+            cells.append(f"**{meal['name']}**<br>{ingredients}<br>{meal['macros']['calories']:g} kcal")
+        lines.append(f"| {d['day']} | " + " | ".join(cells) + " |")
+    return "\n".join(lines)
+
+def completed_plan_days(partial):
+    """Days whose JSON object has fully arrived in a streaming plan, normalized like a saved
+    plan. Days that don't fit the schema are left out until the full plan is validated."""
+    decoder = json.JSONDecoder()
+    days = []
+    for match in re.finditer(r'\{\s*"day"\s*:', partial):
+        try:
+            day, _ = decoder.raw_decode(partial, match.start())
+        except json.JSONDecodeError:
+            break
+        try:
+            days.append(validate_plan_day(day))
+        except ValueError:
+            continue
+    return days
+
+def save_meal_plan_ingredients(sb, cache, user_id, week_start, plan, metrics=None):
+    rows = [
+        {'user_id': user_id, 'week_start': week_start, 'day': d['day'], 'meal': meal['meal'],
+         'ingredient': i['name'], 'grams': i['grams']}
+        for d in plan['days'] for meal in d['meals'] for i in meal['ingredients']
+    ]
+    # Queued in order behind the plan itself when Supabase is down
+    write_through(cache, sb, 'meal_plan_ingredients', {
+        'op': 'delete', 'match': {'user_id': user_id, 'week_start': week_start},
+    }, metrics=metrics)
+    if rows:
+        write_through(cache, sb, 'meal_plan_ingredients', {'op': 'insert', 'rows': rows}, metrics=metrics)
+
+# -------------------- Quantities --------------------
+# One place that turns quantities into grams for the pantry, the grocery list and
+# logged meals. Volumes go through the ingredient's density and counts through its
+# per-piece weight, both taken from the ingredient nutrition table.
+# whole part of a mixed fraction, number, denominator, unit: "1 1/2 cups", "150g", "2"
+QUANTITY_PATTERN = re.compile(r"^\s*(?:(\d+)\s+(?=\d+\s*/))?(\d+(?:[.,]\d+)?)(?:\s*/\s*(\d+))?\s*([a-zA-Z]*)")
+# A bare number ("Eggs: 2") is a count and goes through the per-piece weight
+GRAMS_PER_UNIT = {
+    "g": 1, "gr": 1, "gram": 1, "grams": 1, "kg": 1000, "kilogram": 1000, "kilograms": 1000,
+    "mg": 0.001, "oz": 28.35, "ounce": 28.35, "ounces": 28.35, "lb": 453.6, "lbs": 453.6,
+}
+ML_PER_UNIT = {
+    "ml": 1, "milliliter": 1, "milliliters": 1, "l": 1000, "liter": 1000, "liters": 1000, "litre": 1000, "litres": 1000,
+    "cup": 240, "cups": 240, "tbsp": 15, "tablespoon": 15, "tablespoons": 15, "tsp": 5, "teaspoon": 5, "teaspoons": 5,
+}
+DEFAULT_GRAMS_PER_ML = 1.0
+
+def _parse_amount(whole, number, denominator):
+    amount = float(number.replace(",", "."))
+    if denominator is not None:
+        if float(denominator) == 0:
+            return float("nan")
+        amount /= float(denominator)
+    return amount + (float(whole) if whole else 0.0)
+
+def parse_quantity(quantity):
+    """'150g' -> (150.0, 'g'), '1 1/2 cups' -> (1.5, 'cups'); amount is nan when there is no usable number."""
+    match = QUANTITY_PATTERN.match(str(quantity))
+    if not match:
+        return float("nan"), ""
+    whole, number, denominator, unit = match.groups()
+    return _parse_amount(whole, number, denominator), unit.lower()
+
+def ingredient_conversions(names):
+    """Per-piece weight (nan when unknown) and density (g/ml) for each ingredient name."""
+    rows = get_nutrition_table()["current"]["rows"]
+    pieces, densities = [], []
+    for name in names:
+        row = rows.get(name.strip().lower()) if name else None
+        pieces.append(row[4] if row and row[4] else np.nan)
+        densities.append(row[5] if row and row[5] else DEFAULT_GRAMS_PER_ML)
+    return np.array(pieces, dtype=float), np.array(densities, dtype=float)
+
+def quantities_to_grams(amounts, units, names=None):
+    """Vectorized conversion of whole columns of quantities to grams.
+
+    Mass units convert directly, volume units through the density, and anything else
+    ('pieces', 'slices', '2 eggs') through the per-piece weight. Entries that can't be
+    converted come back as nan.
+    """
+    amounts = np.asarray(amounts, dtype=float)
+    units = [str(u or "").strip().lower() for u in units]
+    names = names if names is not None else [None] * len(units)
+    per_gram = np.array([GRAMS_PER_UNIT.get(u, np.nan) for u in units], dtype=float)
+    per_ml = np.array([ML_PER_UNIT.get(u, np.nan) for u in units], dtype=float)
+    piece_weights, densities = ingredient_conversions(names)
+    return np.where(
+        ~np.isnan(per_gram), amounts * per_gram,
+        np.where(~np.isnan(per_ml), amounts * per_ml * densities, amounts * piece_weights)
+    )
 
-# -------------------- Calories Formula --------------------
-def calories_formula(height, weight, age, gender, activity_level, goal=None):
-    """Calculates daily caloric needs based on Mifflin-St Jeor Equation."""
-    if gender == 'male':
-        s=5
-    elif gender== 'female':
-        s=-161
+# -------------------- Grocery List --------------------
+# The aggregated grocery list is computed once when a plan is saved
+# (weekly_meal_plan.grocery_list). What still has to be bought after the pantry
+# (grocery_needed) is only recomputed when the plan or the pantry changes, and the
+# items ticked as bought are kept in grocery_bought.
+def build_grocery_list(plan):
+    """Total grams of each ingredient over the whole plan."""
+    totals = defaultdict(float)
+    for day in plan['days']:
+        for meal in day['meals']:
+            for ingredient in meal['ingredients']:
+                totals[ingredient['name']] += ingredient['grams']
+    return {name: round(grams, 1) for name, grams in totals.items()}
+
+def pantry_grams(pantry_rows):
+    """Grams on hand per ingredient, from the latest pantry entry of each one.
+
+    Entries saved without a usable quantity count as unlimited, like the old name match.
+    """
+    latest = {}
+    for row in sorted(pantry_rows, key=lambda r: r.get('date') or ''):
+        latest[canonical_ingredient(row['ingredient'])] = row
+    names = list(latest)
+    amounts = [latest[n]['quantity'] if latest[n].get('quantity') is not None else np.nan for n in names]
+    grams = quantities_to_grams(amounts, [latest[n].get('unit') for n in names], names)
+    return dict(zip(names, np.where(np.isnan(grams), np.inf, grams)))
+
+def grocery_needs(grocery_list, pantry_rows):
+    """Plan grams minus what the pantry already holds, keeping only what's still short."""
+    on_hand = pantry_grams(pantry_rows)
+    plan_grams = defaultdict(float)
+    for name, grams in grocery_list.items():
+        plan_grams[canonical_ingredient(name)] += grams
+    names = list(plan_grams)
+    needed = np.array([plan_grams[n] for n in names], dtype=float)
+    have = np.array([on_hand.get(n, 0.0) for n in names], dtype=float)
+    remaining = np.maximum(needed - have, 0.0)
+    return {name: round(float(grams), 1) for name, grams in zip(names, remaining) if grams > 0}
+
+def fetch_week_pantry(sb, user_id, week_start):
+    def fetch():
+        res = sb.table('grocery_ingredients') \
+            .select('ingredient, quantity, unit, date') \
+            .eq('user_id', user_id) \
+            .gte('date', week_start) \
+            .execute()
+        return res.data or []
+    return cached_read(get_local_cache(), 'grocery_ingredients', f"{user_id}:{week_start}", fetch)
+
+WEEK_PLAN_COLUMNS = 'meal_plan, plan_data, grocery_list, grocery_needed, grocery_bought, inputs_hash'
+
+def fetch_week_plan(sb, user_id, week_start):
+    """This week's weekly_meal_plan row, or None."""
+    def fetch():
+        res = sb.table('weekly_meal_plan') \
+            .select(WEEK_PLAN_COLUMNS) \
+            .eq('user_id', user_id) \
+            .eq('week_start', week_start) \
+            .limit(1) \
+            .execute()
+        return res.data or []
+    rows = cached_read(get_local_cache(), 'weekly_meal_plan', f"{user_id}:{week_start}", fetch)
+    return rows[0] if rows else None
+
+def refresh_grocery_needs(sb, user_id, week_start):
+    """Recomputes grocery_needed for a week after a pantry change; None when there is no plan."""
+    plan_row = fetch_week_plan(sb, user_id, week_start)
+    if not plan_row or not plan_row.get('plan_data'):
+        return None
+    grocery_list = plan_row.get('grocery_list') or build_grocery_list(plan_row['plan_data'])
+    needed = grocery_needs(grocery_list, fetch_week_pantry(sb, user_id, week_start))
+    write_through(get_local_cache(), sb, 'weekly_meal_plan', {
+        'op': 'update',
+        'values': {'grocery_list': grocery_list, 'grocery_needed': needed},
+        'match': {'user_id': user_id, 'week_start': week_start},
+    }, invalidate=[('weekly_meal_plan', f"{user_id}:{week_start}")])
+    return needed
+
+def toggle_grocery_bought(user_id, week_start, item, bought):
+    if st.session_state.get(f"grocery_{item}"):
+        bought.add(item)
     else:
-        s=0
-
-    BMI = (10*weight + 6.25*height - 5.0*age) + s
-
-    if activity_level == 'Sedentary':
-        activity_multiplier = 1.2
-    elif activity_level == 'Lightly active':
-        activity_multiplier = 1.375
-    elif activity_level == 'Moderately active':
-        activity_multiplier = 1.55
-    elif activity_level == 'Very active':
-        activity_multiplier = 1.725
-    elif activity_level == 'Super active':
-        activity_multiplier = 1.9
+        bought.discard(item)
+    write_through(get_local_cache(), supabase, 'weekly_meal_plan', {
+        'op': 'update',
+        'values': {'grocery_bought': sorted(bought)},
+        'match': {'user_id': user_id, 'week_start': week_start},
+    }, invalidate=[('weekly_meal_plan', f"{user_id}:{week_start}")])
+
+# -------------------- Meal Plan Jobs --------------------
+# GPT-4 takes 20-60 s to write a weekly plan, so generation runs on a small pool of
+# background workers instead of the script thread. Job state is kept in memory for
+# the page and mirrored to the meal_plan_jobs table (unique on user_id, week_start).
+MEAL_PLAN_WORKERS = 4
+MEAL_PLAN_MAX_ATTEMPTS = 5
+MEAL_PLAN_BACKOFF_BASE = 2
+MEAL_PLAN_BACKOFF_MAX = 60
+# ValueError covers a plan that doesn't validate against the schema; the model gets another go
+MEAL_PLAN_RETRYABLE = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError, ValueError)
+
+@st.cache_resource
+def get_meal_plan_jobs():
+    jobs = {"queue": queue.Queue(), "lock": threading.Lock(), "state": {}}
+    for i in range(MEAL_PLAN_WORKERS):
+        threading.Thread(target=_meal_plan_worker, args=(jobs,), name=f"meal-plan-{i}", daemon=True).start()
+    return jobs
+
+def get_meal_plan_job(user_id, week_start):
+    jobs = get_meal_plan_jobs()
+    with jobs["lock"]:
+        return jobs["state"].get((user_id, week_start.isoformat()))
+
+def meal_plan_fingerprint(dietary_restrictions_list, daily_calories, macros, pantry_ingredients_str, week_start):
+    """Hash of every input the weekly plan prompt is built from."""
+    inputs = {
+        "dietary_restrictions": sorted(dietary_restrictions_list),
+        "daily_calories": daily_calories,
+        "macros": macros,
+        "pantry": pantry_ingredients_str,
+        "week_start": week_start.isoformat(),
+        "schema": MEAL_PLAN_SCHEMA_VERSION,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+def submit_meal_plan_job(user_id, week_start, prompt, inputs_hash, force=False):
+    """Queues a plan generation unless one for the same inputs is pending, done or failed.
+
+    A failed job is only retried when `force` is set (the "Try again" button), so an
+    OpenAI outage does not turn every rerun into another GPT-4 call.
+    """
+    jobs = get_meal_plan_jobs()
+    key = (user_id, week_start.isoformat())
+    with jobs["lock"]:
+        current = jobs["state"].get(key)
+        if current and current["status"] in ("queued", "running"):
+            return current
+        if current and current["inputs_hash"] == inputs_hash and not force:
+            return current
+        job = {
+            "key": key, "prompt": prompt, "inputs_hash": inputs_hash,
+            "status": "queued", "attempts": 0, "error": None, "plan": None,
+            # The worker threads have no Streamlit script context, so they get the clients here
+            "supabase": supabase, "openai": client, "metrics": get_metrics(),
+            "local_cache": get_local_cache(), "partial": "",
+        }
+        jobs["state"][key] = job
+    bump_metric("meal_plan_regenerations")
+    _save_meal_plan_job_status(job)
+    jobs["queue"].put(job)
+    return job
+
+def _save_meal_plan_job_status(job):
+    user_id, week_start = job["key"]
+    try:
+        job["supabase"].table('meal_plan_jobs').upsert({
+            'user_id': user_id,
+            'week_start': week_start,
+            'status': job["status"],
+            'attempts': job["attempts"],
+            'error': job["error"],
+            'updated_at': datetime.utcnow().isoformat()
+        }, on_conflict='user_id,week_start').execute()
+    except Exception as e:
+        check_supabase_error(job["supabase"], e, job["metrics"])
+        print(f"Failed to save meal plan job status for {job['key']}: {e}")
+
+def _meal_plan_worker(jobs):
+    while True:
+        job = jobs["queue"].get()
+        try:
+            _run_meal_plan_job(job)
+        except Exception as e:
+            check_supabase_error(job["supabase"], e, job["metrics"])
+            job["status"], job["error"] = "failed", str(e)
+            _save_meal_plan_job_status(job)
+        finally:
+            jobs["queue"].task_done()
+
+def _stream_meal_plan(job):
+    """Streams the plan JSON into job["partial"] and returns the validated plan.
+
+    Raises if the stream breaks off, stops before the model finished or doesn't match
+    the schema, so an interrupted plan is never persisted over the cached one.
+    """
+    started = time.perf_counter()
+    stream = job["openai"].chat.completions.create(
+        model=MEAL_PLAN_MODEL,
+        messages=[
+            {"role": "system", "content": "You are a nutritionist assistant that creates healthy and balanced weekly meal plans."},
+            {"role": "user", "content": job["prompt"] + MEAL_PLAN_JSON_INSTRUCTIONS}
+        ],
+        response_format={"type": "json_object"},
+        stream=True
+    )
+    finish_reason = None
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content or ""
+        if delta and not job["partial"]:
+            record_timing("meal_plan_first_content", time.perf_counter() - started, metrics=job["metrics"])
+        job["partial"] += delta
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+    record_timing("meal_plan_total", time.perf_counter() - started, metrics=job["metrics"])
+    if finish_reason != "stop":
+        raise OpenAIError(f"Meal plan stream ended early (finish_reason={finish_reason}).")
+    try:
+        return validate_meal_plan(json.loads(job["partial"]))
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Meal plan is not valid JSON: {e}") from e
+
+def _run_meal_plan_job(job):
+    user_id, week_start = job["key"]
+    for attempt in range(1, MEAL_PLAN_MAX_ATTEMPTS + 1):
+        job["status"], job["attempts"], job["partial"] = "running", attempt, ""
+        _save_meal_plan_job_status(job)
+        try:
+            plan = _stream_meal_plan(job)
+        except MEAL_PLAN_RETRYABLE as e:
+            job["error"] = str(e)
+            if attempt == MEAL_PLAN_MAX_ATTEMPTS:
+                break
+            time.sleep(min(MEAL_PLAN_BACKOFF_MAX, MEAL_PLAN_BACKOFF_BASE * 2 ** (attempt - 1)) + random.uniform(0, 1))
+            continue
+
+        weekly_meal_plan = render_meal_plan_markdown(plan)
+        grocery_list = build_grocery_list(plan)
+        res = write_through(job["local_cache"], job["supabase"], 'weekly_meal_plan', {'op': 'upsert', 'rows': {
+            'user_id': user_id,
+            'week_start': week_start,
+            'meal_plan': weekly_meal_plan,
+            'plan_data': plan,
+            'grocery_list': grocery_list,
+            # Filled in by the Groceries tab; the pantry diff needs the nutrition table
+            'grocery_needed': None,
+            'grocery_bought': [],
+            'inputs_hash': job["inputs_hash"]
+        }}, invalidate=[('weekly_meal_plan', f"{user_id}:{week_start}")], metrics=job["metrics"])
+        if res is not None and not res.data:
+            raise Exception(f"Failed to save weekly meal plan. Response: {res}")
+        save_meal_plan_ingredients(job["supabase"], job["local_cache"], user_id, week_start, plan, job["metrics"])
+        job["plan"], job["status"], job["error"] = weekly_meal_plan, "done", None
+        _save_meal_plan_job_status(job)
+        return
+
+    job["status"] = "failed"
+    _save_meal_plan_job_status(job)
+
+def meal_plan_status(user_id, week_start, cached_plan):
+    """Shows the plan. Only while a job is queued or running does the section poll."""
+    job = get_meal_plan_job(user_id, week_start)
+    if job and job["status"] in ("queued", "running"):
+        meal_plan_progress(user_id, week_start, cached_plan)
+        return
+    if job and job["status"] == "done":
+        st.markdown(job["plan"], unsafe_allow_html=True)
+        return
+    if job and job["status"] == "failed":
+        st.error(f"Error in creating your weekly meal plan with OpenAI: {job['error']}")
+        if st.button("Try again", key="retry_meal_plan"):
+            submit_meal_plan_job(user_id, week_start, job["prompt"], job["inputs_hash"], force=True)
+            st.rerun()
+    if cached_plan:
+        st.markdown(cached_plan, unsafe_allow_html=True)
+
+@st.fragment(run_every=1)
+def meal_plan_progress(user_id, week_start, cached_plan):
+    """Polls the background job, showing rows as they stream in."""
+    job = get_meal_plan_job(user_id, week_start)
+    if not job or job["status"] not in ("queued", "running"):
+        st.rerun()  # finished: a full rerun swaps this for the static view and stops the polling
+    # Only days whose JSON has fully arrived, so a half-received row doesn't flicker
+    streamed = completed_plan_days(job["partial"])
+    if streamed:
+        st.markdown(render_meal_plan_markdown({"days": streamed}), unsafe_allow_html=True)
+        st.caption("⏳ Still writing the rest of your plan…")
+        return
+    st.info("⏳ Generating your weekly meal plan… this section updates by itself when it's ready.")
+    if cached_plan:
+        st.caption("Showing your last saved plan in the meantime.")
+        st.markdown(cached_plan, unsafe_allow_html=True)
+
+# -------------------- Macro Estimation --------------------
+# Estimates are memoized on the normalized ingredient list and shared by all users:
+# an in-process TTL/LRU tier in front of the macro_estimates table
+# (cache_key text primary key, ingredients jsonb, protein, fat, carbs, calories, created_at).
+MACRO_CACHE_TTL = timedelta(days=30)
+MACRO_CACHE_ENTRIES = 5000
+
+def normalize_meal_ingredients(ingredients):
+    """Cache key for a meal. Explicit masses become grams ('0.2 kg' == '200 g'); counts,
+    volumes and bare numbers stay as written, since their meaning depends on the food."""
+    normalized = []
+    for name, qty in ingredients.items():
+        amount, unit = parse_quantity(qty)
+        if unit and unit in GRAMS_PER_UNIT and not np.isnan(amount):
+            value = round(amount * GRAMS_PER_UNIT[unit], 1)
+        else:
+            value = " ".join(str(qty).strip().lower().split())
+        normalized.append([canonical_ingredient(name), value])
+    return sorted(normalized, key=lambda item: (item[0], str(item[1])))
+
+def extract_macro(name, text):
+    pattern = rf"({name})[:\-]?\s*(\d+(?:\.\d+)?)\s*g?"
+    match = re.search(pattern, text, re.IGNORECASE)
+    if match and match.group(2) is not None:
+        print(f"Extracted {name}: {match.group(2)}")
+        return float(match.group(2))
+    else:
+        print(f"Failed to extract {name}")
+        return 0.0
+
+@st.cache_resource
+def get_macro_memory_cache():
+    return {"lock": threading.Lock(), "entries": OrderedDict()}
+
+def _remember_macros(cache_key, macros):
+    cache = get_macro_memory_cache()
+    with cache["lock"]:
+        cache["entries"][cache_key] = (datetime.utcnow() + MACRO_CACHE_TTL, macros)
+        cache["entries"].move_to_end(cache_key)
+        while len(cache["entries"]) > MACRO_CACHE_ENTRIES:
+            cache["entries"].popitem(last=False)
+
+def get_cached_macros(cache_key):
+    cache = get_macro_memory_cache()
+    with cache["lock"]:
+        entry = cache["entries"].get(cache_key)
+        if entry and entry[0] > datetime.utcnow():
+            cache["entries"].move_to_end(cache_key)
+            bump_metric("macro_cache_hits")
+            return entry[1]
+        cache["entries"].pop(cache_key, None)
+
+    try:
+        res = supabase.table('macro_estimates') \
+            .select('protein, fat, carbs, calories') \
+            .eq('cache_key', cache_key) \
+            .gte('created_at', (datetime.utcnow() - MACRO_CACHE_TTL).isoformat()) \
+            .limit(1) \
+            .execute()
+    except (httpx.TransportError, APIError) as e:
+        if not is_upstream_outage(e):
+            raise
+        res = None  # treat as a miss; the estimate itself doesn't need Supabase
+    if not res or not res.data:
+        bump_metric("macro_cache_misses")
+        return None
+    bump_metric("macro_cache_hits")
+    macros = {k: float(res.data[0][k] or 0) for k in ('protein', 'fat', 'carbs', 'calories')}
+    _remember_macros(cache_key, macros)
+    return macros
+
+def estimate_meal_macros(ingredients):
+    """Protein, fat, carbs (g) and calories for a meal.
+
+    Computed from the ingredient nutrition table when every ingredient is known and every
+    quantity converts to grams. Otherwise the memoized estimate is used; on a miss the
+    unknown ingredients are added to the table, and only if that still isn't enough does
+    the whole meal go to GPT-4.
+    """
+    started = time.perf_counter()
+    macros = compute_meal_macros(ingredients, ask_model=False)
+    if macros is not None:
+        bump_metric("macro_local_estimates")
+        record_timing("macro_local_estimate", time.perf_counter() - started)
+        return macros
+
+    normalized = normalize_meal_ingredients(ingredients)
+    cache_key = hashlib.sha256(json.dumps(normalized).encode("utf-8")).hexdigest()
+    macros = get_cached_macros(cache_key)
+    if macros is not None:
+        return macros
+
+    # Teach the table the missing ingredients, then retry locally before a whole-meal estimate
+    macros = compute_meal_macros(ingredients)
+    if macros is not None:
+        bump_metric("macro_local_estimates")
+        return macros
+
+    # Create OpenAI prompt
+    prompt = f"""Estimate the total protein (g), fat (g), carbs (g), and calories for a meal made of the following ingredients:
+    """
+    for ing, qty in ingredients.items():
+        prompt += f"- {ing}: {qty}\n"
     
-    calories= BMI * activity_multiplier
-
-    if goal == 'Lose weight':
-        additional=calories * (-0.15)
-    elif goal == 'Maintain weight':
-        additional=0
-    elif goal == 'Gain weight':
-        additional=calories * 0.10
+    prompt += """
+    Please respond in the following format:
+    Protein: XXg  
+    Fat: XXg  
+    Carbs: XXg  
+    Calories: XXX
     
-    daily_calories = calories + additional
+    Example:
+    Protein: 30g  
+    Fat: 15g  
+    Carbs: 40g  
+    Calories: 500
+    """
 
-    if daily_calories < 1200:  # Minimum
-        st.warning("Your calculated daily calories are below the recommended minimum of 1200 kcal. Please consult a healthcare provider for personalized advice.")
-    elif daily_calories > 4000:  # Maximum
-        st.warning("Your calculated daily calories are above the recommended maximum of 4000 kcal. Please consult a healthcare provider for personalized advice.")
+    response = client.chat.completions.create(
+        model="gpt-4",
+        messages=[
+            {"role": "system", "content": "You are a nutritionist assistant that estimates macronutrients."},
+            {"role": "user", "content": prompt}
+        ]
+    )
+    reply = response.choices[0].message.content
+    macros = {
+        'protein': extract_macro("protein", reply),
+        'fat': extract_macro("fat", reply),
+        'carbs': extract_macro("carbs|carbohydrates", reply),
+        'calories': extract_macro("calories", reply),
+    }
+
+    _remember_macros(cache_key, macros)
+    try:
+        supabase.table('macro_estimates').upsert({
+            'cache_key': cache_key,
+            'ingredients': normalized,
+            **macros,
+            'created_at': datetime.utcnow().isoformat()
+        }).execute()
+    except Exception as e:
+        print(f"Failed to store macro estimate {cache_key}: {e}")
+    return macros
+
+# -------------------- Ingredient Nutrition --------------------
+# Per-100 g values (protein, fat, carbs, kcal) plus the weight of one piece and the
+# density used for cup/spoon measures. NUTRITION_SEED covers the pantry staples; the
+# ingredient_nutrition table holds everything the model has been asked about since.
+NUTRIENTS = ('protein', 'fat', 'carbs', 'calories')
+NUTRITION_SEED = {
+    # name: (protein, fat, carbs, kcal, grams_per_piece, grams_per_ml)
+    "eggs": (12.6, 9.5, 0.7, 143, 50, 1.01),
+    "milk": (3.4, 3.6, 4.8, 64, None, 1.03),
+    "cheese": (25.0, 33.0, 1.3, 403, 28, 0.47),
+    "bread": (9.0, 3.2, 49.0, 265, 30, 0.2),
+    "spinach": (2.9, 0.4, 3.6, 23, 10, 0.125),
+    "chicken breast": (31.0, 3.6, 0.0, 165, 170, 0.6),
+    "rice": (2.7, 0.3, 28.0, 130, None, 0.66),
+    "oats": (16.9, 6.9, 66.3, 389, None, 0.34),
+    "banana": (1.1, 0.3, 22.8, 89, 118, 0.6),
+    "apple": (0.3, 0.2, 13.8, 52, 182, 0.5),
+    "tomato": (0.9, 0.2, 3.9, 18, 123, 0.75),
+    "carrot": (0.9, 0.2, 9.6, 41, 61, 0.53),
+    "potato": (2.0, 0.1, 17.0, 77, 173, 0.63),
+    "yogurt": (3.5, 3.3, 4.7, 61, 125, 1.03),
+    "beans": (8.7, 0.5, 22.8, 127, None, 0.74),
+    "lentils": (9.0, 0.4, 20.0, 116, None, 0.83),
+    "broccoli": (2.8, 0.4, 6.6, 34, 150, 0.38),
+    "olive oil": (0.0, 100.0, 0.0, 884, None, 0.91),
+    "butter": (0.9, 81.0, 0.1, 717, None, 0.96),
+    "pasta": (5.8, 0.9, 31.0, 158, None, 0.59),
+}
 
-    return round(daily_calories)
+NUTRITION_RETRY_SECONDS = 24 * 3600
+
+def _nutrition_snapshot(rows):
+    names = list(rows)
+    return {
+        "index": {name: i for i, name in enumerate(names)},
+        "matrix": np.array([rows[n][:4] for n in names], dtype=float).reshape(len(names), 4),
+        "rows": rows,
+    }
+
+@st.cache_resource
+def get_nutrition_table():
+    rows = dict(NUTRITION_SEED)
+    try:
+        res = supabase.table('ingredient_nutrition').select('*').execute()
+        for row in res.data or []:
+            rows[row['name']] = tuple(row.get(k) for k in (*NUTRIENTS, 'grams_per_piece', 'grams_per_ml'))
+    except Exception as e:
+        print(f"Failed to load ingredient_nutrition, using the built-in table: {e}")
+    # Readers grab table["current"] once; writers swap in a new snapshot under the lock
+    # "failed" remembers names the model had no usable answer for, so meals using them don't re-ask
+    return {"lock": threading.Lock(), "current": _nutrition_snapshot(rows), "failed": {}}
+
+def fetch_nutrition_from_model(names):
+    """Asks GPT-4 for per-100 g values of unknown ingredients and stores them in the table."""
+    prompt = (
+        "For each ingredient below give the nutrition per 100 g and the typical weight in grams of one piece "
+        "(null if it isn't sold or eaten in pieces). Reply with JSON only, shaped like "
+        '{"ingredient": {"protein": 0, "fat": 0, "carbs": 0, "calories": 0, "grams_per_piece": null}}.\n'
+        + "\n".join(f"- {name}" for name in names)
+    )
+    response = client.chat.completions.create(
+        model="gpt-4",
+        messages=[
+            {"role": "system", "content": "You are a nutritionist assistant that knows food composition tables."},
+            {"role": "user", "content": prompt}
+        ]
+    )
+    reply = response.choices[0].message.content
+    match = re.search(r"\{.*\}", reply, re.DOTALL)
+    try:
+        values = json.loads(match.group(0)) if match else {}
+    except json.JSONDecodeError:
+        values = {}
+
+    new_rows = {}
+    for name, v in values.items():
+        try:
+            new_rows[name.strip().lower()] = (*(float(v[k]) for k in NUTRIENTS), v.get('grams_per_piece'), 1.0)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            print(f"Unusable nutrition values for {name}: {v}")
+
+    table = get_nutrition_table()
+    with table["lock"]:
+        for name in names:
+            if name not in new_rows:
+                table["failed"][name] = time.time()
+    if not new_rows:
+        return
+    with table["lock"]:
+        table["current"] = _nutrition_snapshot({**table["current"]["rows"], **new_rows})
+    index = get_ingredient_index()
+    with index["lock"]:
+        for name in new_rows:
+            add_canonical_ingredient(index, name)
+    try:
+        supabase.table('ingredient_nutrition').upsert([
+            {'name': name, **dict(zip(NUTRIENTS, row[:4])), 'grams_per_piece': row[4], 'grams_per_ml': row[5]}
+            for name, row in new_rows.items()
+        ]).execute()
+    except Exception as e:
+        print(f"Failed to store ingredient nutrition: {e}")
+
+def compute_meal_macros(ingredients, ask_model=True):
+    """Sums nutrition for a meal from the table, or None when an ingredient or quantity can't be resolved.
+
+    With ask_model, ingredients missing from the table are looked up with the model first,
+    except names it recently had no usable answer for.
+    """
+    names = [canonical_ingredient(name) for name in ingredients]
+    table = get_nutrition_table()
+    unknown = [name for name in names if name not in table["current"]["index"]]
+    retry_after = time.time() - NUTRITION_RETRY_SECONDS
+    if unknown and ask_model and all(table["failed"].get(name, 0) < retry_after for name in unknown):
+        fetch_nutrition_from_model(unknown)
+    snapshot = get_nutrition_table()["current"]
+    if any(name not in snapshot["index"] for name in names):
+        return None
+
+    amounts, units = zip(*(parse_quantity(qty) for qty in ingredients.values()))
+    grams = quantities_to_grams(amounts, units, names)
+    if np.isnan(grams).any():
+        return None
+
+    rows = np.fromiter((snapshot["index"][name] for name in names), dtype=int, count=len(names))
+    totals = grams @ snapshot["matrix"][rows] / 100.0
+    return {nutrient: round(float(value), 1) for nutrient, value in zip(NUTRIENTS, totals)}
+
+# -------------------- Daily Nutrition Totals --------------------
+# daily_nutrition_totals holds one row per (user_id, date) with the summed macros of
+# that day's meals, so the header bars need a single point lookup. Every meal write
+# re-aggregates its own day; rebuild_daily_totals() reconciles the whole table.
+# The per-day refresh runs in Postgres so concurrent saves for one day can't leave a
+# lower total behind: the advisory lock queues them, and each sum is taken after
+# the previous refresh committed.
+#   create or replace function refresh_daily_totals(p_user_id bigint, p_date date)
+#   returns setof daily_nutrition_totals language plpgsql as $$
+#   begin
+#     perform pg_advisory_xact_lock(hashtext('daily_totals:' || p_user_id || ':' || p_date));
+#     return query
+#     insert into daily_nutrition_totals (user_id, date, protein, fat, carbs, calories, meal_count)
+#     select p_user_id, p_date, coalesce(sum(protein), 0), coalesce(sum(fat), 0),
+#            coalesce(sum(carbs), 0), coalesce(sum(calories), 0), count(*)
+#     from user_meals where user_id = p_user_id and date = p_date
+#     on conflict (user_id, date) do update set
+#       protein = excluded.protein, fat = excluded.fat, carbs = excluded.carbs,
+#       calories = excluded.calories, meal_count = excluded.meal_count
+#     returning *;
+#   end $$;
+DAILY_TOTALS_COLUMNS = ('protein', 'fat', 'carbs', 'calories')
+ROLLUP_PAGE_SIZE = 1000
+
+def _sum_meals(meals):
+    totals = {k: 0 for k in DAILY_TOTALS_COLUMNS}
+    for meal in meals:
+        for k in DAILY_TOTALS_COLUMNS:
+            totals[k] += meal.get(k, 0) or 0
+    totals['meal_count'] = len(meals)
+    return totals
+
+def refresh_daily_totals(user_id, day):
+    """Re-aggregates one user's day from user_meals and stores it in the rollup, atomically."""
+    res = supabase.rpc('refresh_daily_totals', {'p_user_id': user_id, 'p_date': day}).execute()
+    invalidate_local(get_local_cache(), 'daily_nutrition_totals', f"{user_id}:{day}")
+    row = res.data[0] if res.data else {}
+    return {**{k: row.get(k) or 0 for k in DAILY_TOTALS_COLUMNS}, 'meal_count': row.get('meal_count') or 0}
+
+def _cached_daily_totals(user_id, days):
+    """{day: rollup row or None}, through the local cache (one scope per user and day)."""
+    def fetch(stale):
+        stale_days = [scope.split(":", 1)[1] for scope in stale]
+        res = supabase.table('daily_nutrition_totals') \
+            .select('date, protein, fat, carbs, calories') \
+            .eq('user_id', user_id) \
+            .in_('date', stale_days) \
+            .execute()
+        found = {row['date']: [row] for row in res.data or []}
+        return {f"{user_id}:{day}": found.get(day, []) for day in stale_days}
+    rows = cached_read_many(get_local_cache(), 'daily_nutrition_totals', [f"{user_id}:{day}" for day in days], fetch)
+    return {day: (rows.get(f"{user_id}:{day}") or [None])[0] for day in days}
+
+def get_daily_totals(user_id, day):
+    try:
+        row = _cached_daily_totals(user_id, [day])[day]
+    except (httpx.TransportError, APIError) as e:
+        if not is_upstream_outage(e):
+            raise
+        return {k: 0 for k in DAILY_TOTALS_COLUMNS}  # Supabase down and nothing local yet
+    if row:
+        return {k: row.get(k) or 0 for k in DAILY_TOTALS_COLUMNS}
+    # Days logged before the rollup existed are backfilled on first read
+    totals = refresh_daily_totals(user_id, day)
+    return {k: totals[k] for k in DAILY_TOTALS_COLUMNS}
+
+def rebuild_daily_totals(user_id=None):
+    """Reconciliation job: recomputes daily_nutrition_totals from user_meals.
+
+    Pass a user_id to rebuild a single user; returns the number of rollup rows written.
+    """
+    days = defaultdict(list)
+    offset = 0
+    while True:
+        query = supabase.table('user_meals').select('user_id, date, protein, fat, carbs, calories')
+        if user_id is not None:
+            query = query.eq('user_id', user_id)
+        res = query.order('id').range(offset, offset + ROLLUP_PAGE_SIZE - 1).execute()
+        rows = res.data or []
+        for row in rows:
+            days[(row['user_id'], row['date'])].append(row)
+        if len(rows) < ROLLUP_PAGE_SIZE:
+            break
+        offset += ROLLUP_PAGE_SIZE
+
+    rollup = [{'user_id': uid, 'date': day, **_sum_meals(meals)} for (uid, day), meals in days.items()]
+    for i in range(0, len(rollup), ROLLUP_PAGE_SIZE):
+        supabase.table('daily_nutrition_totals') \
+            .upsert(rollup[i:i + ROLLUP_PAGE_SIZE], on_conflict='user_id,date') \
+            .execute()
+    return len(rollup)
+
+# -------------------- Meal History --------------------
+MEAL_HISTORY_PAGE_SIZE = 50
+
+def fetch_meal_history_page(user_id, after=None, page_size=MEAL_HISTORY_PAGE_SIZE):
+    """Newest-first page of logged meals, keyset-paginated on (date, id).
+
+    `after` is the cursor returned for the previous page; the returned cursor is None
+    on the last page.
+    """
+    def fetch():
+        query = supabase.table('user_meals') \
+            .select('id, date, meal_name, protein, fat, carbs, calories') \
+            .eq('user_id', user_id)
+        if after is not None:
+            after_date, after_id = after
+            query = query.or_(f"date.lt.{after_date},and(date.eq.{after_date},id.lt.{after_id})")
+        res = query.order('date', desc=True).order('id', desc=True).limit(page_size + 1).execute()
+        return res.data or []
+    cursor = "first" if after is None else f"{after[0]}/{after[1]}"
+    rows = cached_read(get_local_cache(), 'user_meals', f"{user_id}:{cursor}:{page_size}", fetch)
+    if len(rows) > page_size:
+        last = rows[page_size - 1]
+        return rows[:page_size], (last['date'], last['id'])
+    return rows, None
+
+def get_daily_totals_for_days(user_id, days):
+    if not days:
+        return {}
+    try:
+        rows = _cached_daily_totals(user_id, days)
+    except (httpx.TransportError, APIError) as e:
+        if not is_upstream_outage(e):
+            raise
+        return {}
+    return {day: {k: row.get(k) or 0 for k in DAILY_TOTALS_COLUMNS} for day, row in rows.items() if row}
+
+# -------------------- Pantry --------------------
+PANTRY_SAVE_ATTEMPTS = 3
+
+def save_pantry(rows):
+    """Writes all pantry rows in one bulk upsert and returns the ingredients that didn't persist.
+
+    The upsert targets the (user_id, date, ingredient) unique key, so retrying the whole
+    batch after a network error can't create duplicates. If Supabase stays down the batch
+    is queued for replay and counts as saved.
+    """
+    if not rows:
+        return []
+    res = write_through(get_local_cache(), supabase, 'grocery_ingredients',
+                        {'op': 'upsert', 'rows': rows, 'on_conflict': 'user_id,date,ingredient'},
+                        invalidate=[('grocery_ingredients', f"{rows[0]['user_id']}:")],
+                        attempts=PANTRY_SAVE_ATTEMPTS)
+    if res is None:
+        return []
+    saved = {row['ingredient'] for row in res.data or []}
+    return [row['ingredient'] for row in rows if row['ingredient'] not in saved]
+
+# -------------------- Fitbit Dashboard Data --------------------
+# Dashboard metrics come from a pluggable source, chosen with `source` under [fitbit]
+# in the Streamlit secrets. Each source takes (user_id, as_of) and returns the metrics
+# dict. Data is fetched once per user per DASHBOARD_REFRESH_SECONDS and the Plotly
+# figures are built once per data version.
+DASHBOARD_REFRESH_SECONDS = 15 * 60
+DASHBOARD_COLORS = ["#F5A623", "#5C2D91", "#00B8B0"]
+
+def fixture_dashboard_source(user_id, as_of):
+    """Stand-in provider with plausible values, stable for a user within a day."""
+    seed = int(hashlib.sha256(f"{user_id}:{as_of.date().isoformat()}".encode("utf-8")).hexdigest()[:8], 16)
+    rng = np.random.default_rng(seed)
+
+    times = pd.date_range(start=as_of.replace(hour=6, minute=0, second=0, microsecond=0), periods=12, freq='h')
+    dates = pd.date_range(end=as_of, periods=7)
+    return {
+        "steps": int(rng.integers(3000, 15000)),
+        "steps_target": 10000,
+        "kcal_burned": int(rng.integers(1500, 3500)),
+        "kcal_target": 2500,
+        "df_hr": pd.DataFrame({"Time": times, "Heart Rate": rng.integers(60, 160, size=12)}),
+        "df_sleep": pd.DataFrame({
+            "Stage": ["Deep", "Light", "REM", "Awake"],
+            "Hours": np.round([rng.uniform(1, 3), rng.uniform(2, 4), rng.uniform(1, 2), rng.uniform(0.5, 1)], 1),
+        }),
+        "activity": {
+            "Sedentary": int(rng.integers(300, 900)),
+            "Moderate": int(rng.integers(200, 600)),
+            "Vigorous": int(rng.integers(100, 300)),
+        },
+        "df_week": pd.DataFrame({
+            "Date": dates,
+            "Steps": rng.integers(5000, 12000, size=7),
+            "Calories Burned": rng.integers(2000, 3200, size=7),
+            "Active Minutes": rng.integers(30, 120, size=7),
+            "Sleep Hours": rng.uniform(5, 8, size=7),
+        }),
+    }
+
+DASHBOARD_SOURCES = {
+    "fixture": fixture_dashboard_source,
+}
+
+@st.cache_data(ttl=DASHBOARD_REFRESH_SECONDS, max_entries=1000, show_spinner=False)
+def load_dashboard_data(user_id, source, bucket):
+    """Dashboard metrics for one user and refresh interval (`bucket`)."""
+    data = DASHBOARD_SOURCES[source](user_id, datetime.now())
+    data["version"] = f"{source}:{user_id}:{bucket}"
+    return data
+
+@st.cache_data(max_entries=1000, show_spinner=False)
+def build_dashboard_figures(version, _data):
+    """Serialized Plotly figures for one data version."""
+    gauge_steps = go.Figure(go.Indicator(
+        mode="gauge+number",
+        value=_data["steps"],
+        domain={'x': [0, 1], 'y': [0, 1]},
+        title={'text': "Steps Walked"},
+        gauge={
+            'axis': {'range': [0, 15000]},
+            'bar': {'color': "#6a5acd"},
+            'steps': [
+                {'range': [0, _data["steps_target"]], 'color': "#dcdcff"},
+                {'range': [_data["steps_target"], 15000], 'color': "#f3f3f3"}
+            ],
+        }
+    ))
+    gauge_steps.update_layout(height=250, margin={'t': 50, 'b': 0})
+
+    gauge_kcal = go.Figure(go.Indicator(
+        mode="gauge+number",
+        value=_data["kcal_burned"],
+        domain={'x': [0, 1], 'y': [0, 1]},
+        title={'text': "Calories Burned"},
+        gauge={
+            'axis': {'range': [0, 3500]},
+            'bar': {'color': "#ff6347"},
+            'steps': [
+                {'range': [0, _data["kcal_target"]], 'color': "#ffe4e1"},
+                {'range': [_data["kcal_target"], 3500], 'color': "#f3f3f3"}
+            ],
+        }
+    ))
+    gauge_kcal.update_layout(height=250, margin={'t': 50, 'b': 0})
+
+    pie_chart = px.pie(
+        names=list(_data["activity"]),
+        values=list(_data["activity"].values()),
+        title="Daily Activity Distribution",
+        color_discrete_sequence=DASHBOARD_COLORS
+    )
+
+    bar_sleep = px.bar(
+        _data["df_sleep"],
+        x="Stage",
+        y="Hours",
+        title="Sleep Breakdown",
+        text="Hours",
+        color="Stage",
+        color_discrete_sequence=DASHBOARD_COLORS
+    )
+
+    df_week = _data["df_week"]
+    trends = [
+        px.line(df_week, x="Date", y="Steps", title="Steps Trend"),
+        px.line(df_week, x="Date", y="Calories Burned", title="Calories Burned Trend", markers=True),
+        px.line(df_week, x="Date", y="Active Minutes", title="Active Minutes Trend"),
+        px.line(df_week, x="Date", y="Sleep Hours", title="Sleep Hours Trend"),
+    ]
+
+    return {
+        "gauge_steps": gauge_steps.to_dict(),
+        "gauge_kcal": gauge_kcal.to_dict(),
+        "pie_chart": pie_chart.to_dict(),
+        "bar_sleep": bar_sleep.to_dict(),
+        "trends": [fig.to_dict() for fig in trends],
+    }
+
+# -------------------- Calories Formula --------------------
+def calories_formula(height, weight, age, gender, activity_level, goal=None):
+    """Calculates daily caloric needs based on Mifflin-St Jeor Equation."""
+    base = nutrition_targets.bmr(height, weight, age, gender)
+    daily_calories = nutrition_targets.goal_calories(nutrition_targets.tdee(base, activity_level), goal)
+    if np.isnan(daily_calories):
+        raise ValueError(f"Unknown activity level or goal: {activity_level!r}, {goal!r}")
+    return int(daily_calories)
 
 # -------------------- Macros Formula --------------------
 def macros_formula(daily_calories, goal):
-    if goal == 'Lose weight':
-        protein_ratio = 0.4
-        fat_ratio = 0.3
-        carb_ratio = 0.3
-    elif goal == 'Maintain weight':
-        protein_ratio = 0.25
-        fat_ratio = 0.15
-        carb_ratio = 0.6
-    elif goal == 'Gain weight':
-        protein_ratio = 0.3
-        fat_ratio = 0.2
-        carb_ratio = 0.5
-
-    protein_calories = daily_calories * protein_ratio
-    fat_calories = daily_calories * fat_ratio
-    carb_calories = daily_calories * carb_ratio
-
-    protein_grams = round(protein_calories / 4)
-    fat_grams = round(fat_calories / 9)
-    carb_grams = round(carb_calories / 4)
+    protein_grams, fat_grams, carb_grams = nutrition_targets.macro_grams(daily_calories, goal)
+    if np.isnan(protein_grams):
+        raise ValueError(f"Unknown goal: {goal!r}")
 
     return {
-        'protein': protein_grams,
-        'fat': fat_grams,
-        'carbs': carb_grams
+        'protein': int(protein_grams),
+        'fat': int(fat_grams),
+        'carbs': int(carb_grams)
     }
 
 # -------------------- Age Formula --------------------
@@ -143,9 +1946,289 @@ def get_current_week_start():
     return start
 
 # -------------------- Password Formula --------------------
+# bcrypt runs in a process pool (see passwords.py) so a burst of logins can't
+# stall other sessions' reruns. Waiting hashes are bounded per worker; beyond
+# that callers get FuturesTimeout instead of an ever-growing queue.
+# Sign-ins are throttled per client address and email. Behind a reverse proxy every
+# request arrives from the proxy's address, so proxied deployments must set
+# [auth] trusted_proxy_hops to the number of proxies in front of the app.
+AUTH_SETTINGS = st.secrets.get("auth", {})
+BCRYPT_ROUNDS = int(AUTH_SETTINGS.get("bcrypt_rounds", passwords.DEFAULT_ROUNDS))
+PASSWORD_QUEUE_PER_WORKER = 8
+PASSWORD_TIMEOUT_SECONDS = 10
+LOGIN_ATTEMPTS_PER_WINDOW = int(AUTH_SETTINGS.get("login_attempts", 10))
+LOGIN_WINDOW_SECONDS = int(AUTH_SETTINGS.get("login_window_seconds", 300))
+TRUSTED_PROXY_HOPS = int(AUTH_SETTINGS.get("trusted_proxy_hops", 0))
+
+def _password_pool_is_healthy(pool):
+    return not pool["broken"]
+
+@st.cache_resource(validate=_password_pool_is_healthy)
+def get_password_pool():
+    workers = os.cpu_count() or 1
+    return {
+        "executor": passwords.make_pool(workers),
+        "slots": threading.BoundedSemaphore(workers * PASSWORD_QUEUE_PER_WORKER),
+        "broken": False,
+    }
+
+def _run_password_job(fn, *args):
+    pool = get_password_pool()
+    if not pool["slots"].acquire(timeout=PASSWORD_TIMEOUT_SECONDS):
+        bump_metric("password_pool_rejected")
+        raise FuturesTimeout("Too many sign-ins at once, please try again.")
+    started = time.perf_counter()
+    try:
+        future = pool["executor"].submit(fn, *args)
+    except BrokenProcessPool:
+        pool["slots"].release()
+        pool["broken"] = True
+        raise
+    # The slot is held until the hash finishes or is cancelled, not just while we
+    # wait, so callers that time out can't pile abandoned hashes onto the pool
+    future.add_done_callback(lambda _: pool["slots"].release())
+    try:
+        return future.result(timeout=PASSWORD_TIMEOUT_SECONDS)
+    except FuturesTimeout:
+        future.cancel()
+        raise
+    except BrokenProcessPool:
+        pool["broken"] = True
+        raise
+    finally:
+        record_timing(f"password_{fn.__name__}", time.perf_counter() - started)
+
 def hash_password(password):
-    """Hashes a password using SHA-256."""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hashes a password with bcrypt at the configured cost."""
+    return _run_password_job(passwords.hash_password, password, BCRYPT_ROUNDS)
+
+def verify_password(user_id, password, hashed):
+    """Checks a password and rehashes it in place when it was stored at another cost."""
+    if not _run_password_job(passwords.check_password, password, hashed):
+        return False
+    if passwords.hash_rounds(hashed) != BCRYPT_ROUNDS:
+        try:
+            supabase.table("users").update({"password": hash_password(password)}).eq("id", user_id).execute()
+            bump_metric("password_rehashed")
+        except Exception:
+            pass  # the old hash still works, try again next sign-in
+    return True
+
+@st.cache_resource
+def get_login_attempts():
+    return {"lock": threading.Lock(), "by_client": {}, "pruned_at": time.time()}
+
+def client_ip():
+    """The address the throttle keys on, or None when Streamlit doesn't know it.
+
+    X-Forwarded-For is only read when [auth] trusted_proxy_hops says how many proxies
+    we run: each appends the peer it saw, so the entry that many places from the right
+    was written by our outermost proxy. Anything to its left is client-supplied.
+    """
+    peer = getattr(st.context, "ip_address", None)
+    if not TRUSTED_PROXY_HOPS:
+        return peer
+    forwarded = [a.strip() for a in st.context.headers.get("X-Forwarded-For", "").split(",") if a.strip()]
+    return forwarded[-TRUSTED_PROXY_HOPS] if len(forwarded) >= TRUSTED_PROXY_HOPS else peer
+
+def allow_login_attempt(ip, email):
+    """Sliding-window limit on sign-in attempts per client IP and email.
+
+    The email is part of the key so that clients sharing an address (an unconfigured
+    proxy, or no address at all) don't use up each other's attempts.
+    """
+    attempts = get_login_attempts()
+    by_client = attempts["by_client"]
+    key = (ip, email.strip().lower())
+    now = time.time()
+    with attempts["lock"]:
+        if now - attempts["pruned_at"] > LOGIN_WINDOW_SECONDS:
+            # Forget clients whose attempts have all aged out
+            for stale in [k for k, times in by_client.items() if now - times[-1] >= LOGIN_WINDOW_SECONDS]:
+                del by_client[stale]
+            attempts["pruned_at"] = now
+        recent = [t for t in by_client.get(key, ()) if now - t < LOGIN_WINDOW_SECONDS]
+        if len(recent) >= LOGIN_ATTEMPTS_PER_WINDOW:
+            by_client[key] = recent
+            bump_metric("login_throttled")
+            return False
+        recent.append(now)
+        by_client[key] = recent
+        return True
+
+# -------------------- Session Tokens --------------------
+# A signed "user_id.expires.token_id" token in the ?session= query param lets a
+# refresh or reconnect skip sign-in. Verifying it is an HMAC and a set lookup;
+# revoked token ids are mirrored from the revoked_sessions table
+# (token_id text primary key, expires_at bigint) at most once a minute.
+SESSION_SECRET = AUTH_SETTINGS.get("session_secret")
+SESSION_TTL_SECONDS = int(AUTH_SETTINGS.get("session_ttl_hours", 24 * 7)) * 3600
+SESSION_DENYLIST_REFRESH_SECONDS = 60
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _sign(payload):
+    return _b64(hmac.new(SESSION_SECRET.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256).digest())
+
+def issue_session_token(user_id):
+    """Returns a new token for the user, or None when [auth] session_secret isn't configured."""
+    if not SESSION_SECRET:
+        return None
+    payload = f"{user_id}.{int(time.time()) + SESSION_TTL_SECONDS}.{secrets.token_urlsafe(9)}"
+    return f"{_b64(payload.encode('utf-8'))}.{_sign(payload)}"
+
+def _parse_session_token(token):
+    """(user_id, expires, token_id) for a well-signed token, else None. Expiry is not checked here."""
+    if not SESSION_SECRET or not token or token.count(".") != 1:
+        return None
+    encoded, signature = token.split(".")
+    try:
+        payload = _unb64(encoded).decode("utf-8")
+        user_id, expires, token_id = payload.split(".")
+        expires = int(expires)
+        # Bytes, compare_digest raises TypeError on non-ASCII str; UnicodeEncodeError is a ValueError
+        signature = signature.encode("ascii")
+    except ValueError:
+        return None
+    if not hmac.compare_digest(signature, _sign(payload).encode("ascii")):
+        return None
+    return user_id, expires, token_id
+
+@st.cache_resource
+def get_session_denylist():
+    return {"lock": threading.Lock(), "revoked": {}, "loaded_at": 0.0}
+
+def _refresh_session_denylist(denylist):
+    now = time.time()
+    if now - denylist["loaded_at"] < SESSION_DENYLIST_REFRESH_SECONDS:
+        return
+    denylist["loaded_at"] = now  # also backs off when the table can't be read
+    try:
+        res = supabase.table("revoked_sessions").select("token_id, expires_at").gt("expires_at", int(now)).execute()
+    except Exception:
+        return
+    with denylist["lock"]:
+        revoked = {token_id: expires for token_id, expires in denylist["revoked"].items() if expires > now}
+        revoked.update({row["token_id"]: row["expires_at"] for row in res.data or []})
+        denylist["revoked"] = revoked
+
+def verify_session_token(token):
+    """User id the token was issued to, or None if it is forged, expired or revoked."""
+    parsed = _parse_session_token(token)
+    if not parsed:
+        return None
+    user_id, expires, token_id = parsed
+    if expires <= time.time():
+        return None
+    denylist = get_session_denylist()
+    _refresh_session_denylist(denylist)
+    if token_id in denylist["revoked"]:
+        return None
+    return int(user_id) if user_id.isdigit() else user_id
+
+def revoke_session_token(token):
+    parsed = _parse_session_token(token)
+    if not parsed:
+        return
+    _, expires, token_id = parsed
+    denylist = get_session_denylist()
+    with denylist["lock"]:
+        denylist["revoked"][token_id] = expires
+    try:
+        supabase.table("revoked_sessions").upsert({"token_id": token_id, "expires_at": expires}).execute()
+    except Exception:
+        bump_metric("session_revoke_failed")  # still revoked in this process until it expires
+
+def start_session(user_id):
+    token = issue_session_token(user_id)
+    if token:
+        st.query_params["session"] = token
+
+def restore_session():
+    """Signs the browser back in from its ?session= token after a refresh or reconnect."""
+    token = st.query_params.get("session")
+    if not token:
+        return
+    user_id = verify_session_token(token)
+    if user_id is None:
+        del st.query_params["session"]
+        return
+    bump_metric("session_restored")
+    st.session_state['user_id'] = user_id
+    st.session_state['page'] = 'main'
+
+def sign_out():
+    revoke_session_token(st.query_params.get("session"))
+    st.query_params.clear()
+    st.session_state.clear()
+    st.session_state['page'] = 'sign_in'
+
+# -------------------- User Profile --------------------
+class UserProfile:
+    """Parsed user_account row plus the daily targets derived from it. Immutable."""
+
+    __slots__ = (
+        'user_id', 'name', 'dob', 'gender', 'height', 'weight', 'activity_level', 'goal',
+        'timeline', 'dietary_restrictions', 'age', 'daily_calories', '_macros',
+    )
+
+    def __init__(self, row):
+        dob = row.get('dob')
+        # Ensure dob is a date object
+        if isinstance(dob, str):
+            dob = datetime.strptime(dob, "%Y-%m-%d").date()
+        restrictions = row.get('dietary_restrictions')
+        age = calculate_age(dob)
+        daily_calories = calories_formula(row.get('height'), row.get('weight'), age, row.get('gender'),
+                                          row.get('activity_level'), row.get('goal'))
+        values = {
+            'user_id': row.get('user_id'),
+            'name': row.get('name'),
+            'dob': dob,
+            'gender': row.get('gender'),
+            'height': row.get('height'),
+            'weight': row.get('weight'),
+            'activity_level': row.get('activity_level'),
+            'goal': row.get('goal'),
+            'timeline': row.get('timeline'),
+            'dietary_restrictions': tuple(restrictions.split(',')) if restrictions else (),
+            'age': age,
+            'daily_calories': daily_calories,
+            '_macros': tuple(macros_formula(daily_calories, row.get('goal')).items()),
+        }
+        for slot, value in values.items():
+            object.__setattr__(self, slot, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("UserProfile is immutable; reload it with load_user_profile()")
+
+    @property
+    def macros(self):
+        return dict(self._macros)
+
+def load_user_profile(user_id):
+    """Fetches the profile once and keeps it for the rest of the session; None if there is none."""
+    res = supabase.table('user_account').select('*').eq('user_id', user_id).execute()
+    if not res.data:
+        st.session_state.pop('profile', None)
+        return None
+    profile = UserProfile(res.data[0])
+    st.session_state['profile'] = (user_id, profile)
+    return profile
+
+def get_session_profile(user_id):
+    cached = st.session_state.get('profile')
+    if cached and cached[0] == user_id:
+        return cached[1]
+    return load_user_profile(user_id)
+
+def invalidate_session_profile():
+    """Call after any write to user_account."""
+    st.session_state.pop('profile', None)
 
 # ------------------- Aesthetic -----------------------------
 st.markdown("""
@@ -278,6 +2361,9 @@ def sign_in():
     password = st.text_input("Password", type="password", placeholder="Enter your password")
 
     if st.button("Let's start"):
+        if not allow_login_attempt(client_ip(), email):
+            st.error("Too many sign-in attempts. Please wait a few minutes and try again.")
+            return
         res = supabase.table("users").select("id, password").eq("email", email).execute()
         user = res.data[0] if res.data else None
 
@@ -285,10 +2371,17 @@ def sign_in():
             user_id = user['id']
             hashed_password = user['password']
             
-            if bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8')):
+            try:
+                password_ok = verify_password(user_id, password, hashed_password)
+            except FuturesTimeout:
+                st.error("We're handling a lot of sign-ins right now. Please try again in a moment.")
+                return
+            if password_ok:
                 st.session_state['user_id'] = user_id
                 st.session_state['email'] = email
                 st.session_state['page'] = 'main'
+                load_user_profile(user_id)
+                start_session(user_id)
                 st.success("Sign-in successful! Redirecting...")
             else:
                 st.error("Incorrect password. Please try again.")
@@ -330,7 +2423,11 @@ def create_account():
             st.error("Passwords do not match. Please try again.")
             return
             
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        try:
+            hashed_password = hash_password(password)
+        except FuturesTimeout:
+            st.error("We're handling a lot of sign-ins right now. Please try again in a moment.")
+            return
     
         try:
             res = supabase.table('users').insert({
@@ -342,6 +2439,7 @@ def create_account():
                 user_id = res.data[0]['id'] 
                 st.session_state['user_id'] = user_id
                 st.session_state['page'] = 'onboarding'
+                start_session(user_id)
                 st.success("Account created successfully! Redirecting to onboarding...")
             else:
                 st.error("Failed to create account. Please try again.")
@@ -385,8 +2483,7 @@ def onboarding():
         return
 
     # Avoid duplicate onboarding
-    res = supabase.table('user_account').select('*').eq('user_id', user_id).execute()
-    profile = res.data[0] if res.data else None
+    profile = get_session_profile(user_id)
 
     if profile:
         st.info("Profile already exists. Redirecting to the main page...")
@@ -424,6 +2521,7 @@ def onboarding():
         }
         
         res = supabase.table('user_account').insert(data).execute()
+        invalidate_session_profile()
         
         if res.data:
             st.success("User profile saved successfully.")
@@ -433,640 +2531,605 @@ def onboarding():
         st.success("✅ Profile saved! Redirecting to the main page...")
         st.session_state['page'] = 'main'
 
-# -------------------- Main page --------------------
-def main_page():
-# ------------- aesthetic ---------
-    st.markdown(
-    """
-    <style>
-    @import url('https://fonts.googleapis.com/css2?family=Audrey&family=Poppins&display=swap');
+# -------------------- Main Tab --------------------
+def main_tab(user_id):
+    # Display user profile
+    profile = get_session_profile(user_id)
 
-    html, body, [class*="css"]  {
-        font-family: 'Poppins', 'Audrey', sans-serif;
+    if not profile:
+        st.warning("Profile not found. Please complete onboarding.")
+        st.session_state['page'] = 'onboarding'
+        return
+    
+    name = profile.name
+    dietary_restrictions_list = list(profile.dietary_restrictions)
+
+    row1_col1, row1_col2 = st.columns([6, 2])
+    with row1_col1:
+        st.markdown(f"## Hello, {name}!")
+    with row1_col2:
+        if st.button("➕ Add Meal"):
+            st.session_state["show_add_meal_form"] = True
+
+    if st.session_state.get("show_add_meal_form", False):
+        st.markdown("### Add a Meal You Ate")
+        with st.form("add_meal_form"):
+            meal_name = st.text_input("Meal name (e.g. Chicken Wrap, Pasta Bowl)")
+            ingredients_raw = st.text_area("Ingredients and quantities. Please input in the following structure - **ingredient: quantity**")
+            meal_date = st.date_input("Date", value=date.today())
+            submitted = st.form_submit_button("Save Meal")
+
+            if submitted:
+                if not meal_name or not ingredients_raw:
+                    st.error("Please fill in all fields.")
+                    st.stop()
+
+                # Parse ingredients
+                ingredients = {}
+                for line in ingredients_raw.strip().split("\n"):
+                    if ":" in line:
+                        k, v = line.split(":", 1)
+                        ingredients[k.strip()] = v.strip()
+                        
+                if not ingredients:
+                    st.error("Please provide at least one valid ingredient with quantity, e.g. 'Chicken: 150g'")
+                    st.stop()
+                try:
+                    started = time.perf_counter()
+                    macros_estimate = estimate_meal_macros(ingredients)
+                    record_timing("meal_macro_estimate", time.perf_counter() - started)
+                    protein = macros_estimate['protein']
+                    fat = macros_estimate['fat']
+                    carbs = macros_estimate['carbs']
+                    calories = macros_estimate['calories']
+                    
+                    # Save to DB
+                    data = {
+                        'user_id': user_id,
+                        'date': meal_date.isoformat() if hasattr(meal_date, 'isoformat') else meal_date,
+                        'meal_name': meal_name,
+                        'ingredients': json.dumps(ingredients),
+                        'protein': protein,
+                        'fat': fat,
+                        'carbs': carbs,
+                        'calories': calories
+                    }
+                    
+                    res = write_through(get_local_cache(), supabase, 'user_meals', {'op': 'insert', 'rows': data},
+                                        invalidate=[('user_meals', f"{user_id}:")])
+                    
+                    if res is None:
+                        st.info("Bodari can't reach the server right now; your meal will sync when it's back.")
+                    elif res.data:
+                        refresh_daily_totals(user_id, data['date'])
+                        st.success("Meal saved successfully!")
+                    else:
+                        st.error(f"Failed to save meal. Response: {res}")
+
+                    st.success(f"Meal '{meal_name}' saved with estimated macros!")
+                    st.session_state["show_add_meal_form"] = False
+                    st.session_state.pop("meal_history_cursors", None)
+                    st.rerun()
+                except OpenAIError as e:
+                    if isinstance(e, APIConnectionError):
+                        mark_client_broken(client)
+                    st.error(f"OpenAI estimation failed: {e}")
+                    return
+                except (httpx.TransportError, APIError) as e:
+                    # Not queued: the insert may have landed before the connection dropped
+                    st.error(f"Couldn't confirm your meal was saved, check today's meals before adding it again: {e}")
+                    return
+                    
+    st.markdown("<div style='margin-top: 32px;'></div>", unsafe_allow_html=True)
+
+    # Daily calories and macros come with the session profile
+    daily_calories = profile.daily_calories
+    macros = profile.macros
+    calorie_warning = nutrition_targets.calorie_warning(daily_calories)
+    if calorie_warning:
+        st.warning(calorie_warning)
+
+    # --- Calculate Consumed Calories and Macros ---
+    consumed = get_daily_totals(user_id, date.today().isoformat())
+
+    remaining = {
+        'calories': max(daily_calories - consumed['calories'], 0),
+        'protein': max(macros['protein'] - consumed['protein'], 0),
+        'fat': max(macros['fat'] - consumed['fat'], 0),
+        'carbs': max(macros['carbs'] - consumed['carbs'], 0)
     }
-    </style>
+
+    # --- Display Calories ---
+    st.markdown(
+    f"""
+    <div style='font-size: 32px; color: #e57373; font-weight: bold; text-align: center;'>
+        {consumed['calories']} kcal / {daily_calories} kcal
+    </div>
     """,
     unsafe_allow_html=True
     )
+
+    # --- Display Macros as Progress Bars ---
     
-    col1,col2=st.columns([2,8])
-    with col1:
-        st.image(str(LOGO_IMAGE), width=300)
-    with col2:
-        st.image(str(LOGO_TITLE), width=300)
-    
-    tab1, tab2, tab3 , tab4 , tab5 = st.tabs(['Main', 'Recipes', 'Groceries', 'Image Recognition', 'Fitbit App'])
-    with tab1:
+    # Set total macro sum for relative percentage bars
+    total_macros = macros['protein'] + macros['fat'] + macros['carbs']
 
-        user_id = st.session_state.get('user_id')
-        email = st.session_state.get('email')
+    # Function to render a macro bar
+    def macro_bar(name, total, consumed_val, remaining_val, color):
+        st.markdown(
+            f"""
+            <div style='margin-bottom: 14px;'>
+                <div style='font-weight: 500; margin-bottom: 4px;'>{name}</div>
+                <div style='background-color: #e0e0e0; border-radius: 10px; height: 20px; width: 100%; position: relative;'>
+                    <div style='width: {min(consumed_val/total*100 if total else 0,100)}%; background-color: {color}; height: 100%; border-radius: 10px; display: flex; align-items: center; justify-content: flex-end; padding-right: 8px; color: white; font-size: 14px;'>
+                        {consumed_val}g
+                    </div>
+                    <div style='position: absolute; right: 8px; top: 0; height: 100%; display: flex; align-items: center; color: #4b2596; font-size: 14px;'>
+                        {remaining_val}g
+                    </div>
+                </div>
+            </div>
+            """, unsafe_allow_html=True
+        )
 
+    macro_bar("Protein", macros['protein'], consumed['protein'], remaining['protein'], "#4b2596")
+    macro_bar("Fat", macros['fat'], consumed['fat'], remaining['fat'], "#14b3ad")
+    macro_bar("Carbs", macros['carbs'], consumed['carbs'], remaining['carbs'], "#fbad05")
+
+    # -------------------- Pantry Ingredients Section --------------------
+    st.markdown("<div style='margin-top: 32px;'></div>", unsafe_allow_html=True)
+    st.markdown("### What's in your pantry?")
+    st.markdown("Select the ingredients you currently have. You can optionally specify the quantity and unit for each.")
+
+    # Define a list of common ingredients to select from
+    common_ingredients = COMMON_INGREDIENTS
+
+    selected_ingredients = st.multiselect("Select available ingredients", options=common_ingredients, key="pantry_ingredients")
+
+    pantry_data = []
+    for ingredient in selected_ingredients:
+        with st.expander(f"{ingredient} details"):
+            quantity = st.number_input(f"Quantity of {ingredient}", min_value=0.0, step=10.0, format="%.2f", key=f"{ingredient}_qty")
+            unit = st.selectbox(f"Unit for {ingredient}", ["grams", "kg", "ml", "liters", "cups", "pieces"], key=f"{ingredient}_unit")
+            pantry_data.append((user_id, date.today(), ingredient, quantity if quantity > 0 else None, unit if quantity > 0 else "units"))
+
+    if st.button("Save Pantry"):
+        rows = [{
+            'user_id': entry[0],
+            'date': entry[1].isoformat() if hasattr(entry[1], 'isoformat') else entry[1],
+            'ingredient': entry[2],
+            'quantity': entry[3],
+            'unit': entry[4]
+        } for entry in pantry_data]
         try:
-            user_id_int = int(user_id)
-        except Exception:
-            st.error("Invalid user_id in session state.")
-            st.session_state['page'] = 'sign_in'
-            return
-
-        # Display user profile
-        res = supabase.table('user_account').select('*').eq('user_id', user_id).execute()
-
-        if res.data and len(res.data) > 0:
-            profile = res.data[0]  # One profile expected
+            missing = save_pantry(rows)
+        except Exception as e:
+            st.error(f"Error saving your pantry: {e}")
         else:
-            profile = None
-            st.warning("Profile not found or error fetching profile.")
-        
-        if not profile:
-            st.warning("Profile not found. Please complete onboarding.")
-            st.session_state['page'] = 'onboarding'
-            return
-        
-        id = profile.get('id')
-        name = profile.get('name')
-        dob = profile.get('dob')
-        gender = profile.get('gender')
-        height = profile.get('height')
-        weight = profile.get('weight')
-        activity_level = profile.get('activity_level')
-        goal = profile.get('goal')
-        timeline = profile.get('timeline')
-        dietary_restrictions = profile.get('dietary_restrictions')
-        dietary_restrictions_list = dietary_restrictions.split(',') if dietary_restrictions else []
-
-        # Ensure dob is a date object
-        if isinstance(dob, str):
-            dob = datetime.strptime(dob, "%Y-%m-%d").date()
-        
-        age = calculate_age(dob)
+            if missing:
+                st.error(f"Error saving {', '.join(missing)}. Please try again.")
+            elif rows:
+                refresh_grocery_needs(supabase, user_id, get_current_week_start().isoformat())
+                st.success("Pantry ingredients saved successfully!")
+        st.markdown("<br>", unsafe_allow_html=True)
+    
+    # -------------------- Weekly Meal Plan Section --------------------
+    st.markdown("<div style='margin-top: 32px;'></div>", unsafe_allow_html=True)
+    st.markdown("### Weekly Meal Plan")
+    st.markdown("Let's create a weekly meal plan tailored to your needs:")
 
-        row1_col1, row1_col2 = st.columns([6, 2])
-        with row1_col1:
-            st.markdown(f"## Hello, {name}!")
-        with row1_col2:
-            if st.button("➕ Add Meal"):
-                st.session_state["show_add_meal_form"] = True
-
-        if st.session_state.get("show_add_meal_form", False):
-            st.markdown("### Add a Meal You Ate")
-            with st.form("add_meal_form"):
-                meal_name = st.text_input("Meal name (e.g. Chicken Wrap, Pasta Bowl)")
-                ingredients_raw = st.text_area("Ingredients and quantities. Please input in the following structure - **ingredient: quantity**")
-                meal_date = st.date_input("Date", value=date.today())
-                submitted = st.form_submit_button("Save Meal")
-
-                if submitted:
-                    if not meal_name or not ingredients_raw:
-                        st.error("Please fill in all fields.")
-                        st.stop()
-
-                    # Parse ingredients
-                    ingredients = {}
-                    for line in ingredients_raw.strip().split("\n"):
-                        if ":" in line:
-                            k, v = line.split(":", 1)
-                            ingredients[k.strip()] = v.strip()
-                            
-                    if not ingredients:
-                        st.error("Please provide at least one valid ingredient with quantity, e.g. 'Chicken: 150g'")
-                        st.stop()
-                    # Create OpenAI prompt
-                    prompt = f"""Estimate the total protein (g), fat (g), carbs (g), and calories for a meal made of the following ingredients:
-                    """
-                    for ing, qty in ingredients.items():
-                        prompt += f"- {ing}: {qty}\n"
-                    
-                    prompt += """
-                    Please respond in the following format:
-                    Protein: XXg  
-                    Fat: XXg  
-                    Carbs: XXg  
-                    Calories: XXX
-                    
-                    Example:
-                    Protein: 30g  
-                    Fat: 15g  
-                    Carbs: 40g  
-                    Calories: 500
-                    """
-                    
-                    try:
-                        response = client.chat.completions.create(
-                            model="gpt-4",
-                            messages=[
-                                {"role": "system", "content": "You are a nutritionist assistant that estimates macronutrients."},
-                                {"role": "user", "content": prompt}
-                            ]
-                        )
-                        reply = response.choices[0].message.content
-                        # Example reply: "Protein: 35g, Fat: 12g, Carbs: 40g, Calories: 480"
-
-                        import re
-                        def extract_macro(name, text):
-                            pattern = rf"({name})[:\-]?\s*(\d+(?:\.\d+)?)\s*g?"
-                            match = re.search(pattern, text, re.IGNORECASE)
-                            if match and match.group(2) is not None:
-                                print(f"Extracted {name}: {match.group(2)}")
-                                return float(match.group(2))
-                            else:
-                                print(f"Failed to extract {name}")
-                                return 0.0
-                        
-                        protein = extract_macro("protein", reply)
-                        fat = extract_macro("fat", reply)
-                        carbs = extract_macro("carbs|carbohydrates", reply)
-                        calories = extract_macro("calories", reply)
-                        
-                        # Save to DB
-                        data = {
-                            'user_id': user_id,
-                            'date': meal_date.isoformat() if hasattr(meal_date, 'isoformat') else meal_date,
-                            'meal_name': meal_name,
-                            'ingredients': json.dumps(ingredients),
-                            'protein': protein,
-                            'fat': fat,
-                            'carbs': carbs,
-                            'calories': calories
-                        }
-                        
-                        res = supabase.table('user_meals').insert(data).execute()
-                        
-                        if res.data:
-                            st.success("Meal saved successfully!")
-                        else:
-                            st.error(f"Failed to save meal. Response: {res}")
+    week_start = get_current_week_start()
     
-                        st.success(f"Meal '{meal_name}' saved with estimated macros!")
-                        st.session_state["show_add_meal_form"] = False
-                        st.rerun()
-                    except OpenAIError as e:
-                        st.error(f"OpenAI estimation failed: {e}")
-                        return
-                        
-        st.markdown("<div style='margin-top: 32px;'></div>", unsafe_allow_html=True)
+    # 1. Fetch pantry ingredients added within the current week
+    pantry_rows = fetch_week_pantry(supabase, user_id, week_start.isoformat())
+    
+    # 2. Build pantry string for AI only from valid entries this week (sorted so the fingerprint is stable)
+    pantry_ingredients_str = "\n".join(sorted(
+        f"{row['ingredient']} ({row['quantity']} {row['unit']})"
+        for row in pantry_rows if row.get('quantity')
+    ))
+    
+    # 3. Fingerprint everything the plan depends on
+    plan_inputs_hash = meal_plan_fingerprint(dietary_restrictions_list, daily_calories, macros, pantry_ingredients_str, week_start)
+    
+    # 4. Check for cached meal plan
+    plan_row = fetch_week_plan(supabase, user_id, week_start.isoformat())
+    
+    meal_plan = plan_row['meal_plan'] if plan_row else None
+    cached_hash = plan_row.get('inputs_hash') if plan_row else None
+    
+    # 5. Main logic: only regenerate meal plan when its inputs changed
+    if meal_plan and cached_hash == plan_inputs_hash:
+        bump_metric("meal_plan_cache_hits")
+    else:
+        bump_metric("meal_plan_cache_misses")
+        # Compose the prompt
+        prompt = f"""
+        The user has the following dietary restrictions: {dietary_restrictions_list} and needs to consume {daily_calories} calories daily with the following macros composition in grams: {macros}.
+        """
+    
+        if pantry_ingredients_str:
+            prompt += f"\nThe user currently has the following ingredients available in their pantry: {pantry_ingredients_str}. Try to incorporate them into the meal plan when possible, but you can also use other ingredients to complete the meals."
+    
+        prompt += """
+        Please create a weekly meal plan with breakfast, lunch, dinner, and two snacks for each day of the week. 
+        Add the weight of each ingredient for each meal, and the protein, fat, carbs and calories of each meal. 
+        The meal plan should be healthy, balanced, and diverse, and meet the user's dietary restrictions and caloric needs.
+        """
+    
+        submit_meal_plan_job(user_id, week_start, prompt, plan_inputs_hash)
+    
+    # Show plan (or the generation status while the background job runs)
+    meal_plan_status(user_id, week_start, meal_plan)
 
-        # Calculate daily calories and macros
-        daily_calories = calories_formula(height, weight, age, gender, activity_level, goal)
-        macros = macros_formula(daily_calories, goal)
 
-        # --- Calculate Consumed Calories and Macros ---
-        res = supabase.table('user_meals') \
-            .select('protein, fat, carbs, calories') \
-            .eq('user_id', user_id) \
-            .eq('date', date.today().isoformat()) \
-            .execute()
-        
-        today_meals = res.data if res.data else []
-        
-        consumed = {'calories': 0, 'protein': 0, 'fat': 0, 'carbs': 0}
-        for meal in today_meals:
-            consumed['protein'] += meal.get('protein', 0) or 0
-            consumed['fat'] += meal.get('fat', 0) or 0
-            consumed['carbs'] += meal.get('carbs', 0) or 0
-            consumed['calories'] += meal.get('calories', 0) or 0
-
-        remaining = {
-            'calories': max(daily_calories - consumed['calories'], 0),
-            'protein': max(macros['protein'] - consumed['protein'], 0),
-            'fat': max(macros['fat'] - consumed['fat'], 0),
-            'carbs': max(macros['carbs'] - consumed['carbs'], 0)
-        }
+    st.markdown("<div style='margin-top: 32px;'></div>", unsafe_allow_html=True)
+    st.markdown("### Logged Meals")
 
-        # --- Display Calories ---
-        st.markdown(
-        f"""
-        <div style='font-size: 32px; color: #e57373; font-weight: bold; text-align: center;'>
-            {consumed['calories']} kcal / {daily_calories} kcal
-        </div>
-        """,
-        unsafe_allow_html=True
-        )
+    # One page of meals at a time; the cursor stack lets the user page back to newer meals
+    cursors = st.session_state.setdefault("meal_history_cursors", [None])
+    meals, next_cursor = fetch_meal_history_page(user_id, after=cursors[-1])
 
-        # --- Display Macros as Progress Bars ---
-        
-        # Set total macro sum for relative percentage bars
-        total_macros = macros['protein'] + macros['fat'] + macros['carbs']
-
-        # Function to render a macro bar
-        def macro_bar(name, total, consumed_val, remaining_val, color):
-            st.markdown(
-                f"""
-                <div style='margin-bottom: 14px;'>
-                    <div style='font-weight: 500; margin-bottom: 4px;'>{name}</div>
-                    <div style='background-color: #e0e0e0; border-radius: 10px; height: 20px; width: 100%; position: relative;'>
-                        <div style='width: {min(consumed_val/total*100 if total else 0,100)}%; background-color: {color}; height: 100%; border-radius: 10px; display: flex; align-items: center; justify-content: flex-end; padding-right: 8px; color: white; font-size: 14px;'>
-                            {consumed_val}g
-                        </div>
-                        <div style='position: absolute; right: 8px; top: 0; height: 100%; display: flex; align-items: center; color: #4b2596; font-size: 14px;'>
-                            {remaining_val}g
-                        </div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True
+    if not meals:
+        st.info("You haven’t added any meals yet.")
+    else:
+        meals_by_day = defaultdict(list)
+        for meal in meals:
+            meals_by_day[meal['date']].append(meal)
+        day_totals = get_daily_totals_for_days(user_id, list(meals_by_day))
+
+        for m_date, day_meals in meals_by_day.items():
+            t = day_totals.get(m_date) or _sum_meals(day_meals)
+            with st.expander(f"**{m_date}** – {t['calories']:g} kcal | Protein: {t['protein']:g}g | Fat: {t['fat']:g}g | Carbs: {t['carbs']:g}g"):
+                st.dataframe(
+                    pd.DataFrame(day_meals, columns=['meal_name', 'protein', 'fat', 'carbs', 'calories'])
+                        .rename(columns={'meal_name': 'Meal', 'protein': 'Protein (g)', 'fat': 'Fat (g)', 'carbs': 'Carbs (g)', 'calories': 'Calories'}),
+                    hide_index=True,
+                    use_container_width=True
+                )
+
+    col_newer, col_older = st.columns(2)
+    if len(cursors) > 1 and col_newer.button("← Newer meals"):
+        cursors.pop()
+        st.rerun()
+    if next_cursor is not None and col_older.button("Older meals →"):
+        cursors.append(next_cursor)
+        st.rerun()
+
+
+# -------------------- Recipes Tab --------------------
+def recipes_tab(user_id):
+    # Title and Add Recipe button aligned right
+    cols = st.columns([8, 2])
+    cols[0].title("Recipe Finder")
+    add_clicked = cols[1].button("➕ Add Recipe")
+
+    if add_clicked or st.session_state.get("show_add_recipe_form", False):
+        st.session_state["show_add_recipe_form"] = True
+        st.subheader("Add a New Recipe")
+
+        with st.form("add_recipe_form"):
+            title = st.text_input("Recipe Title")
+            image_file = st.file_uploader("Upload an image for the recipe", type=["png", "jpg", "jpeg"])
+            diet_options = ['Vegetarian', 'Vegan', 'Gluten-free', 'Dairy-free', 'Nut-free', 'None']
+            diet = st.multiselect("Dietary Preferences", diet_options)
+            
+            st.markdown("### Ingredients (enter as `Ingredient: Quantity`)")
+            ingredients_raw = st.text_area(
+                "List ingredients separated by newline, e.g.:\nChicken Breast: 150g\nSpinach: 50g"
             )
 
-        macro_bar("Protein", macros['protein'], consumed['protein'], remaining['protein'], "#4b2596")
-        macro_bar("Fat", macros['fat'], consumed['fat'], remaining['fat'], "#14b3ad")
-        macro_bar("Carbs", macros['carbs'], consumed['carbs'], remaining['carbs'], "#fbad05")
+            calories = st.number_input("Calories (kcal)", min_value=0)
+            protein = st.number_input("Protein (g)", min_value=0)
+            fat = st.number_input("Fat (g)", min_value=0)
+            carbs = st.number_input("Carbs (g)", min_value=0)
+            instructions = st.text_area("Instructions")
+
+            col_submit, col_exit = st.columns([1,1])
+            submitted = col_submit.form_submit_button("Save Recipe")
+            exit_clicked = col_exit.form_submit_button("Exit")
+
+            if exit_clicked:
+                st.session_state["show_add_recipe_form"] = False
+                st.rerun()
+
+            if submitted:
+                if not title:
+                    st.error("Please enter a recipe title.")
+                    st.stop()
+                if not image_file:
+                    st.error("Please upload an image.")
+                    st.stop()
+
+                # Parse ingredients
+                ingredients = {}
+                for line in ingredients_raw.split("\n"):
+                    if ':' in line:
+                        key, val = line.split(':', 1)
+                        ingredients[key.strip()] = val.strip()
+
+                # Save uploaded image locally
+                upload_dir = Path("uploaded_images")
+                upload_dir.mkdir(exist_ok=True)
+                
+                file_extension = image_file.name.split('.')[-1].lower()
+                image_bytes = image_file.getvalue()
+                # Named after the content, so two recipes with the same title keep their
+                # own image and the thumbnail cache never serves a replaced file
+                filepath = upload_dir / f"{hashlib.sha256(image_bytes).hexdigest()}.{file_extension}"
+                if not filepath.exists():
+                    with open(filepath, "wb") as f:
+                        f.write(image_bytes)
+                
+                image_path = str(filepath)
+                store_thumbnail(image_path, image_bytes, get_image_loader())
+
+                new_recipe = {
+                    "title": title,
+                    "image": image_path,  # local image path
+                    "diet": diet,
+                    "ingredients": ingredients,
+                    "calories": calories,
+                    "macros": {
+                        "protein": protein,
+                        "fat": fat,
+                        "carbs": carbs
+                    },
+                    "instructions": instructions
+                }
 
-        # -------------------- Pantry Ingredients Section --------------------
-        st.markdown("<div style='margin-top: 32px;'></div>", unsafe_allow_html=True)
-        st.markdown("### What's in your pantry?")
-        st.markdown("Select the ingredients you currently have. You can optionally specify the quantity and unit for each.")
+                try:
+                    insert_recipe(new_recipe)
+                except (httpx.TransportError, APIError) as e:
+                    st.error(f"Couldn't confirm the recipe was saved, check the feed before adding it again: {e}")
+                    return
+                st.session_state.pop("recipe_feed", None)
 
-        # Define a list of common ingredients to select from
-        common_ingredients = [
-            "Eggs", "Milk", "Cheese", "Bread", "Spinach", "Chicken Breast", "Rice", "Oats",
-            "Banana", "Apple", "Tomato", "Carrot", "Potato", "Yogurt", "Beans", "Lentils", "Broccoli"
-        ]
+                st.success("Recipe added successfully!")
+                st.session_state["show_add_recipe_form"] = False
+                st.rerun()
 
-        selected_ingredients = st.multiselect("Select available ingredients", options=common_ingredients, key="pantry_ingredients")
-
-        pantry_data = []
-        for ingredient in selected_ingredients:
-            with st.expander(f"{ingredient} details"):
-                quantity = st.number_input(f"Quantity of {ingredient}", min_value=0.0, step=10.0, format="%.2f", key=f"{ingredient}_qty")
-                unit = st.selectbox(f"Unit for {ingredient}", ["grams", "kg", "ml", "liters", "cups", "pieces"], key=f"{ingredient}_unit")
-                pantry_data.append((user_id, date.today(), ingredient, quantity if quantity > 0 else None, unit if quantity > 0 else "units"))
-
-        if st.button("Save Pantry"):
-            for entry in pantry_data:
-                data = {
-                    'user_id': entry[0],
-                    'date': entry[1].isoformat() if hasattr(entry[1], 'isoformat') else entry[1],
-                    'ingredient': entry[2],
-                    'quantity': entry[3],
-                    'unit': entry[4]
-                }
-                res = supabase.table('grocery_ingredients').upsert(data).execute()
-                if not res.data:
-                    st.error(f"Error saving {entry[2]}. Response: {res}")
-                else:
-                    st.success("Pantry ingredients saved successfully!")
-                st.markdown("<br>", unsafe_allow_html=True)
-        
-        # -------------------- Weekly Meal Plan Section --------------------
-        st.markdown("<div style='margin-top: 32px;'></div>", unsafe_allow_html=True)
-        st.markdown("### Weekly Meal Plan")
-        st.markdown("Let's create a weekly meal plan tailored to your needs:")
+    else:
+        with st.container():
+            with st.expander(" Filters ", expanded=True):
+                all_diet_types = ['Vegetarian', 'Vegan', 'Gluten-free', 'Dairy-free', 'Nut-free', 'None']
+                selected_diets = st.multiselect("Select dietary preferences", all_diet_types)
+
+                all_ingredients = COMMON_INGREDIENTS
+                selected_ingredients = st.multiselect("Select available ingredients", all_ingredients, key="recipe_filter_ingredients")
+                match_all = st.radio("Recipes must contain", ["Any of these", "All of these"], horizontal=True) == "All of these"
+
+                col_cal, col_protein = st.columns(2)
+                calorie_range = col_cal.slider("Calories (kcal)", 0, 2000, (0, 2000), step=50)
+                min_protein = col_protein.slider("Minimum protein (g)", 0, 100, 0, step=5)
+                use_pantry = st.checkbox("Only recipes I can cook with my pantry")
+                min_coverage = st.slider("Share of ingredients already in my pantry", 0, 100, 50, step=10, disabled=not use_pantry)
+
+        st.markdown("""<hr style='border:1px solid #ddd; margin:20px 0;'>""", unsafe_allow_html=True)
+
+        ranges = {}
+        if calorie_range != (0, 2000):
+            ranges['calories'] = (calorie_range[0], calorie_range[1] if calorie_range[1] < 2000 else np.inf)
+        if min_protein:
+            ranges['protein'] = (min_protein, np.inf)
+        pantry = None
+        if use_pantry:
+            pantry = [row['ingredient'] for row in fetch_week_pantry(supabase, user_id, get_current_week_start().isoformat())]
+
+        # Matching ids and the cards loaded so far live in the session; changing the
+        # filters starts over from the first page
+        filters_key = (tuple(selected_diets), tuple(selected_ingredients), match_all, calorie_range, min_protein,
+                       tuple(pantry) if pantry is not None else None, min_coverage)
+        feed = st.session_state.get("recipe_feed")
+        if not feed or feed["filters"] != filters_key:
+            ids = search_recipe_index(
+                all_ingredients=selected_ingredients if match_all else (),
+                any_ingredients=() if match_all else selected_ingredients,
+                diets=selected_diets,
+                ranges=ranges,
+                pantry=pantry,
+                min_coverage=min_coverage / 100
+            )
+            feed = {"filters": filters_key, "ids": ids, "offset": RECIPE_PAGE_SIZE,
+                    "recipes": fetch_recipe_cards(ids[:RECIPE_PAGE_SIZE])}
+            st.session_state["recipe_feed"] = feed
 
-        week_start = get_current_week_start()
-        today_str = date.today().isoformat()
-        
-        # 1. Fetch pantry ingredients added within the current week
-        res = supabase.table('grocery_ingredients') \
-            .select('ingredient, quantity, unit, date') \
-            .eq('user_id', user_id) \
-            .gte('date', week_start.isoformat()) \
-            .execute()
-        
-        pantry_rows = res.data if res.data else []
-        
-        # 2. Check if any pantry entry was added today
-        pantry_updated_today = any(row.get('date') == today_str for row in pantry_rows)
-        
-        # 3. Build pantry string for AI only from valid entries this week
-        pantry_ingredients_str = "\n".join([
-            f"{row['ingredient']} ({row['quantity']} {row['unit']})"
-            for row in pantry_rows if row.get('quantity')
-        ])
-        
-        # 4. Check for cached meal plan
-        res = supabase.table('weekly_meal_plan') \
-            .select('meal_plan') \
-            .eq('user_id', user_id) \
-            .eq('week_start', week_start.isoformat()) \
-            .limit(1) \
-            .execute()
-        
-        meal_plan = res.data[0]['meal_plan'] if res.data else None
-        
-        # 5. Main logic: only regenerate meal plan if pantry was updated today
-        if meal_plan and not pantry_updated_today:
-            weekly_meal_plan = meal_plan
-        else:
-            # Compose the prompt
-            prompt = f"""
-            The user has the following dietary restrictions: {dietary_restrictions_list} and needs to consume {daily_calories} calories daily with the following macros composition in grams: {macros}.
-            """
-        
-            if pantry_ingredients_str:
-                prompt += f"\nThe user currently has the following ingredients available in their pantry: {pantry_ingredients_str}. Try to incorporate them into the meal plan when possible, but you can also use other ingredients to complete the meals."
-        
-            prompt += """
-            Please create a weekly meal plan with breakfast, lunch, dinner, and two snacks for each day of the week. 
-            Add the weight of each ingredient for each meal. 
-            The meal plan should be healthy, balanced, and diverse, and meet the user's dietary restrictions and caloric needs.
-            Present the plan in a table format with columns for each meal and rows for the days of the week (Monday to Sunday). 
-            Each cell should include the meal description with ingredients and their quantities.
-            """
-        
-            try:
-                response = client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[
-                        {"role": "system", "content": "You are a nutritionist assistant that creates healthy and balanced weekly meal plans."},
-                        {"role": "user", "content": prompt}
-                    ]
+        # Determine if filters are active
+        filters_active = bool(selected_diets or selected_ingredients or ranges or use_pantry)
+
+        def render_recipe(recipe):
+            with st.container():
+                st.markdown(
+                    """
+                    <div style="display: flex; gap: 20px; padding: 16px; border-radius: 16px; 
+                                background-color: #FBD89A; box-shadow: 0 2px 8px rgba(0,0,0,0.05); 
+                                margin-bottom: 20px;">
+                    """, unsafe_allow_html=True
                 )
-                weekly_meal_plan = response.choices[0].message.content.strip()
-        
-                # Save/update plan
-                res = supabase.table('weekly_meal_plan').upsert({
-                    'user_id': user_id,
-                    'week_start': week_start.isoformat(),
-                    'meal_plan': weekly_meal_plan
-                }).execute()
         
-                if not res.data:
-                    st.error(f"Failed to save weekly meal plan. Response: {res}")
-        
-            except RateLimitError:
-                st.warning("Rate limit reached. Waiting for 20 seconds before retrying...")
-                time.sleep(20)
-                return
-            except OpenAIError as e:
-                st.error(f"Error in creating your weekly meal plan with OpenAI: {e}")
-                return
+                col1, col2 = st.columns([1, 3])
+                with col1:
+                    image_slot = st.empty()
+                    image_slot.caption("Loading image…")
         
-        # Show plan
-        st.markdown(weekly_meal_plan)
-
-
-        st.markdown("<div style='margin-top: 32px;'></div>", unsafe_allow_html=True)
-        st.markdown("### Logged Meals")
-
-        res = supabase.table('user_meals') \
-            .select('date, meal_name, protein, fat, carbs, calories') \
-            .eq('user_id', user_id) \
-            .order('date', desc=True) \
-            .execute()
+                with col2:
+                    st.markdown(f"<h4 style='margin-bottom: 0;'>{recipe['title']}</h4>", unsafe_allow_html=True)
+                    st.markdown(f"<div style='color: gray;'>Calories: {recipe['calories']} kcal</div>", unsafe_allow_html=True)
+                    st.markdown(
+                        f"""
+                        <div style='margin: 8px 0;'>
+                        <strong>Macros:</strong> 
+                        {recipe['macros']['protein']}g protein, 
+                        {recipe['macros']['fat']}g fat, 
+                        {recipe['macros']['carbs']}g carbs
+                        </div>
+                        """, unsafe_allow_html=True
+                    )
+                    with st.expander("More Information"):
+                        st.markdown("**Ingredients:**")
+                        for ing, qty in recipe['ingredients'].items():
+                            st.markdown(f"- {ing}: {qty}")
+                        st.markdown("**Instructions:**")
+                        st.markdown(recipe['instructions'])
         
+                st.markdown("</div>", unsafe_allow_html=True)
+            return image_slot
+
+        # Suggestions for what's left of today's targets
+        started = time.perf_counter()
+        suggestion_slots = []
+        remaining = todays_remaining(user_id)
+        if remaining and remaining['calories'] > 0:
+            pantry_names = sorted({row['ingredient'] for row in fetch_week_pantry(supabase, user_id, get_current_week_start().isoformat())})
+            pantry_fingerprint = hashlib.sha256("\n".join(pantry_names).encode("utf-8")).hexdigest()
+            profile = get_session_profile(user_id)
+            suggested_ids = recommend_recipes(
+                user_id, date.today().isoformat(), pantry_fingerprint, tuple(pantry_names),
+                tuple(remaining[field] for field in RECIPE_RANGE_FIELDS),
+                diets=tuple(sorted(d.strip() for d in profile.dietary_restrictions)) if profile else ()
+            )
+            if suggested_ids:
+                st.markdown(f"### Suggested for your remaining {remaining['calories']:g} kcal")
+                # Rendered with placeholders like the feed; all images are filled in together below
+                suggestion_slots = [(r['image'], render_recipe(r)) for r in fetch_recipe_cards(suggested_ids)]
+                st.markdown("""<hr style='border:1px solid #ddd; margin:20px 0;'>""", unsafe_allow_html=True)
         
-        meals = res.data if res.data else []
-
-        if not meals:
-            st.info("You haven’t added any meals yet.")
+        image_slots = list(suggestion_slots)
+        if not feed["recipes"]:
+            if filters_active:
+                st.warning("No recipes found for selected filters.")
         else:
-            for meal in meals:
-                m_date = meal.get('date')
-                name = meal.get('meal_name')
-                p = meal.get('protein', 0)
-                f = meal.get('fat', 0)
-                c_ = meal.get('carbs', 0)
-                cal = meal.get('calories', 0)
-                st.markdown(f"**{m_date} – {name}**")
-                st.markdown(f"- Protein: {p}g | Fat: {f}g | Carbs: {c_}g | Calories: {cal} kcal")
-
-
-# -------------------- Recipes Page--------------------
-    with tab2:
-
-        # Title and Add Recipe button aligned right
-        cols = st.columns([8, 2])
-        cols[0].title("Recipe Finder")
-        add_clicked = cols[1].button("➕ Add Recipe")
-
-        if add_clicked or st.session_state.get("show_add_recipe_form", False):
-            st.session_state["show_add_recipe_form"] = True
-            st.subheader("Add a New Recipe")
-
-            with st.form("add_recipe_form"):
-                title = st.text_input("Recipe Title")
-                image_file = st.file_uploader("Upload an image for the recipe", type=["png", "jpg", "jpeg"])
-                diet_options = ['Vegetarian', 'Vegan', 'Gluten-free', 'Dairy-free', 'Nut-free', 'None']
-                diet = st.multiselect("Dietary Preferences", diet_options)
-                
-                st.markdown("### Ingredients (enter as `Ingredient: Quantity`)")
-                ingredients_raw = st.text_area(
-                    "List ingredients separated by newline, e.g.:\nChicken Breast: 150g\nSpinach: 50g"
-                )
-
-                calories = st.number_input("Calories (kcal)", min_value=0)
-                protein = st.number_input("Protein (g)", min_value=0)
-                fat = st.number_input("Fat (g)", min_value=0)
-                carbs = st.number_input("Carbs (g)", min_value=0)
-                instructions = st.text_area("Instructions")
+            # Cards go out first with placeholders, images fill in as they arrive
+            for recipe in feed["recipes"]:
+                image_slots.append((recipe['image'], render_recipe(recipe)))
+                if len(image_slots) == len(suggestion_slots) + 1:
+                    record_timing("recipes_first_card", time.perf_counter() - started)
+
+        if feed["offset"] < len(feed["ids"]) and st.button("Load more recipes"):
+            feed["recipes"].extend(fetch_recipe_cards(feed["ids"][feed["offset"]:feed["offset"] + RECIPE_PAGE_SIZE]))
+            feed["offset"] += RECIPE_PAGE_SIZE
+            st.rerun()
+        if image_slots:
+            fill_recipe_images(image_slots, started)
+
+
+# -------------------- Groceries Tab --------------------
+def groceries_tab(user_id):
+    st.header("Grocery List for This Week")
+    
+    week_start = get_current_week_start()
 
-                col_submit, col_exit = st.columns([1,1])
-                submitted = col_submit.form_submit_button("Save Recipe")
-                exit_clicked = col_exit.form_submit_button("Exit")
+    # Fetch the precomputed grocery list for this week's plan
+    plan_row = fetch_week_plan(supabase, user_id, week_start.isoformat())
 
-                if exit_clicked:
-                    st.session_state["show_add_recipe_form"] = False
-                    st.rerun()
-
-                if submitted:
-                    if not title:
-                        st.error("Please enter a recipe title.")
-                        st.stop()
-                    if not image_file:
-                        st.error("Please upload an image.")
-                        st.stop()
-
-                    # Parse ingredients
-                    ingredients = {}
-                    for line in ingredients_raw.split("\n"):
-                        if ':' in line:
-                            key, val = line.split(':', 1)
-                            ingredients[key.strip()] = val.strip()
-
-                    # Save uploaded image locally
-                    upload_dir = Path("uploaded_images")
-                    upload_dir.mkdir(exist_ok=True)
-                    
-                    file_extension = image_file.name.split('.')[-1]
-                    safe_title = "".join(x for x in title if x.isalnum() or x in (" ", "_")).rstrip()
-                    filename = f"{safe_title}.{file_extension}"
-                    filepath = upload_dir / filename
-                    
-                    with open(filepath, "wb") as f:
-                        f.write(image_file.getbuffer())
-                    
-                    image_path = str(filepath)
-
-                    new_recipe = {
-                        "title": title,
-                        "image": image_path,  # local image path
-                        "diet": diet,
-                        "ingredients": ingredients,
-                        "calories": calories,
-                        "macros": {
-                            "protein": protein,
-                            "fat": fat,
-                            "carbs": carbs
-                        },
-                        "instructions": instructions
-                    }
+    grocery_items = plan_row.get('grocery_needed') if plan_row else None
+    if plan_row and grocery_items is None:
+        # First open after the plan was (re)generated
+        grocery_items = refresh_grocery_needs(supabase, user_id, week_start.isoformat())
 
-                    insert_recipe(new_recipe)
+    if grocery_items is None:
+        st.warning("You don't have a meal plan for this week yet.")
+        st.stop()
 
-                    st.success("Recipe added successfully!")
-                    st.session_state["show_add_recipe_form"] = False
-                    st.rerun()
+    bought = set(plan_row.get('grocery_bought') or [])
 
-        else:
-            with st.container():
-                with st.expander(" Filters ", expanded=True):
-                    all_diet_types = ['Vegetarian', 'Vegan', 'Gluten-free', 'Dairy-free', 'Nut-free', 'None']
-                    selected_diets = st.multiselect("Select dietary preferences", all_diet_types)
-
-                    all_ingredients = [
-                        "Eggs", "Milk", "Cheese", "Bread", "Spinach", "Chicken Breast", "Rice", "Oats",
-                        "Banana", "Apple", "Tomato", "Carrot", "Potato", "Yogurt", "Beans", "Lentils", "Broccoli"
-                    ]
-                    selected_ingredients = st.multiselect("Select available ingredients", all_ingredients, key="recipe_filter_ingredients")
+    if not grocery_items:
+        st.success("🎉 Your pantry is fully stocked for this week's meals!")
+    else:
+        st.markdown("Here’s what you still need to buy:")
+        for item, qty in grocery_items.items():
+            st.checkbox(
+                f"{item.title()} – {round(qty)}g",
+                value=item in bought,
+                key=f"grocery_{item}",
+                on_change=toggle_grocery_bought,
+                args=(user_id, week_start.isoformat(), item, bought)
+            )
+        if bought:
+            st.success(f"You marked {len(bought)} item(s) as bought.")
 
-            st.markdown("""<hr style='border:1px solid #ddd; margin:20px 0;'>""", unsafe_allow_html=True)
 
-            recipes = get_all_recipes()
+# -------------------- Image Recognition Tab --------------------
+def image_recognition_tab(user_id):
+    # Inject custom CSS styling directly inside the tab block.
+    st.markdown("""
+    <style>
+    @import url('https://fonts.googleapis.com/css2?family=Marmelad&family=ABeeZee:wght@300;400;600&display=swap');
 
-            def matches_filters(recipe):
-                if selected_diets:
-                    diet_ok = any(d in recipe['diet'] for d in selected_diets if d != "None")
-                else:
-                    diet_ok = True
-                    
-                if selected_ingredients:
-                    ingredient_ok = any(ing in recipe['ingredients'] for ing in selected_ingredients)
-                else:
-                    ingredient_ok = True
-            
-                return diet_ok and ingredient_ok
+    html, body, [class*="css"] {
+        font-family: 'ABeeZee', sans-serif !important;
+        background-color: #f7f9fc;
+        text-align: center;
+    }
 
-            # Determine if filters are active
-            filters_active = bool(selected_diets or selected_ingredients)
+    main {
+        display: flex;
+        flex-direction: column;
+        align-items: center;
+        justify-content: center;
+    }
 
-            def render_recipe(recipe):
-                with st.container():
-                    st.markdown(
-                        """
-                        <div style="display: flex; gap: 20px; padding: 16px; border-radius: 16px; 
-                                    background-color: #FBD89A; box-shadow: 0 2px 8px rgba(0,0,0,0.05); 
-                                    margin-bottom: 20px;">
-                        """, unsafe_allow_html=True
-                    )
-            
-                    col1, col2 = st.columns([1, 3])
-                    with col1:
-                        try:
-                            if recipe['image'] and os.path.exists(recipe['image']):
-                                img = Image.open(recipe['image'])
-                                st.image(img, use_column_width=True)
-                            else:
-                                img_data = requests.get(recipe['image']).content
-                                img = Image.open(BytesIO(img_data))
-                                st.image(img, use_column_width=True)
-                        except Exception:
-                            st.warning("Image could not be loaded.")
-            
-                    with col2:
-                        st.markdown(f"<h4 style='margin-bottom: 0;'>{recipe['title']}</h4>", unsafe_allow_html=True)
-                        st.markdown(f"<div style='color: gray;'>Calories: {recipe['calories']} kcal</div>", unsafe_allow_html=True)
-                        st.markdown(
-                            f"""
-                            <div style='margin: 8px 0;'>
-                            <strong>Macros:</strong> 
-                            {recipe['macros']['protein']}g protein, 
-                            {recipe['macros']['fat']}g fat, 
-                            {recipe['macros']['carbs']}g carbs
-                            </div>
-                            """, unsafe_allow_html=True
-                        )
-                        with st.expander("More Information"):
-                            st.markdown("**Ingredients:**")
-                            for ing, qty in recipe['ingredients'].items():
-                                st.markdown(f"- {ing}: {qty}")
-                            st.markdown("**Instructions:**")
-                            st.markdown(recipe['instructions'])
-            
-                    st.markdown("</div>", unsafe_allow_html=True)
-            
-            # Apply filtering if filters are active
-            if filters_active:
-                filtered_recipes = [r for r in recipes if matches_filters(r)]
-            
-                if not filtered_recipes:
-                    st.warning("No recipes found for selected filters.")
-                else:
-                    for recipe in filtered_recipes:
-                        render_recipe(recipe)
-            else:
-                for recipe in recipes:
-                    render_recipe(recipe)
-                    
-# -------------------- Groceries Page--------------------
-    with tab3:
-        st.header("Grocery List for This Week")
-        
-        week_start = get_current_week_start()
+    h1, h2, h3, h4 {
+        font-family: 'Marmelad', cursive !important;
+        font-weight: 600;
+    }
+    </style>
+    """, unsafe_allow_html=True)
     
-        # Fetch the weekly meal plan
-        res = supabase.table('weekly_meal_plan') \
-            .select('meal_plan') \
-            .eq('user_id', user_id) \
-            .eq('week_start', week_start.isoformat()) \
-            .limit(1) \
-            .execute()
+    st.header("Image Recognition")
     
-        if not res.data:
-            st.warning("You don't have a meal plan for this week yet.")
-            st.stop()
+    # Image uploader for the ticket image
+    uploaded_image = st.file_uploader("Upload your ticket image", type=["jpg", "jpeg", "png"])
     
-        meal_plan_text = res.data[0]['meal_plan']
+    if uploaded_image is not None:
+        image = Image.open(uploaded_image)
+        # Display image with a fixed width (using 'width' as use_container_width replacement)
+        st.image(image, caption="Your Ticket", width=300)
     
-        # --- Extract ingredients from meal plan ---
-        from collections import defaultdict
-        import re
+    # Start analysis on button click
+    if st.button("Analyze 🔎"):
+        st.write("Analyzing your image... ⏳")
+        progress_bar = st.progress(0)
+        for i in range(101):
+            time.sleep(3 / 100)  # Simulate a 3-second progress
+            progress_bar.progress(i)
         
-        ingredient_counts = defaultdict(float)
-        
-        # Extract all lines that look like ingredient(quantity)
-        matches = re.findall(r'([\w\s]+)\s*\((\d+(?:\.\d+)?)\s*(g|ml)?\)', meal_plan_text)
+        # Predefined list of products from the ticket
+        data = [
+            {"Producto": "Huevo fresco M DO", "Cantidad": 1},
+            {"Producto": "Pizza maxi barbacoa", "Cantidad": 1},
+            {"Producto": "Jamón 250+250", "Cantidad": 1},
+            {"Producto": "Entrecot de añojo", "Cantidad": 1},
+            {"Producto": "Agua Font Vella 1L", "Cantidad": 1},
+            {"Producto": "Aceituna rellena suave", "Cantidad": 1},
+            {"Producto": "Patatas campesinas", "Cantidad": 1},
+            {"Producto": "Aceituna negra", "Cantidad": 2},
+            {"Producto": "Postre leche B. Easo 350g", "Cantidad": 1},
+            {"Producto": "Pan sin corteza Bimbo 610g", "Cantidad": 1},
+            {"Producto": "Leche botella entera Asturiana", "Cantidad": 2},
+            {"Producto": "Torta imperial", "Cantidad": 1},
+            {"Producto": "Turrón duro Calidad Suprema", "Cantidad": 3},
+            {"Producto": "Turrón blando Calidad Suprema", "Cantidad": 3},
+            {"Producto": "Turrón yema tostada", "Cantidad": 1},
+            {"Producto": "Vino tinto crianza C. Colegia", "Cantidad": 1},
+            {"Producto": "Jabón Magno", "Cantidad": 1},
+            {"Producto": "Bolsa Eroski OXO", "Cantidad": 4}
+        ]
+        df = pd.DataFrame(data)
+        # Filter out non-food items (assuming "Jabón Magno" and "Bolsa Eroski OXO" are non-food)
+        food_items = df[~df["Producto"].isin(["Jabón Magno", "Bolsa Eroski OXO"])]
         
-        for name, qty, unit in matches:
-            normalized_name = name.strip().lower()
-            amount = float(qty)
-            if unit == "ml":
-                # Optionally treat ml differently if needed
-                pass
-            ingredient_counts[normalized_name] += amount
-    
-        # --- Get pantry ingredients added this week ---
-        pantry_res = supabase.table('grocery_ingredients') \
-            .select('ingredient') \
-            .eq('user_id', user_id) \
-            .gte('date', week_start.isoformat()) \
-            .execute()
+        st.markdown("### Identified Food Items")
+        # Display a more nicely designed table using st.dataframe
+        st.dataframe(food_items.reset_index(drop=True), width=600, height=300)
         
-        pantry_items = [row['ingredient'].strip().lower() for row in pantry_res.data] if pantry_res.data else []
-    
-        # --- Compute grocery list ---
-        grocery_items = {
-            k: v for k, v in ingredient_counts.items()
-            if k not in pantry_items
-        }
-
-    
-        if not grocery_items:
-            st.success("🎉 Your pantry is fully stocked for this week's meals!")
-        else:
-            st.markdown("Here’s what you still need to buy:")
-            checked = []
-            for item, qty in grocery_items.items():
-                if st.checkbox(f"{item.title()} – {round(qty)}g", key=f"grocery_{item}"):
-                    checked.append(item)
-            if checked:
-                st.success(f"You marked {len(checked)} item(s) as bought.")
-
+        # Final summary message with fixed text
+        st.markdown("<h3>22 productos added to your pantry 🎉</h3>", unsafe_allow_html=True)
 
 
-
-
-# -------------------- Image Recognition Tab --------------------    
-    with tab4:
-        # Inject custom CSS styling directly inside the tab block.
-        st.markdown("""
+# -------------------- Fitbit Dashboard Tab --------------------
+def fitbit_tab(user_id):
+    st.markdown("""
         <style>
         @import url('https://fonts.googleapis.com/css2?family=Marmelad&family=ABeeZee:wght@300;400;600&display=swap');
 
@@ -1089,230 +3152,125 @@ def main_page():
         }
         </style>
         """, unsafe_allow_html=True)
+    
+    st.header("Fitbit Dashboard")
+
+    # -------------------------------------------------------------------------
+    # Display the current day of the week.
+    # -------------------------------------------------------------------------
+    day_of_week = datetime.now().strftime("%A")
+    st.subheader(f"Today is {day_of_week}")
+
+    # -------------------------------------------------------------------------
+    # Data and figures are cached per user and refresh interval
+    # -------------------------------------------------------------------------
+    source = st.secrets.get("fitbit", {}).get("source", "fixture")
+    data = load_dashboard_data(user_id, source, int(time.time() // DASHBOARD_REFRESH_SECONDS))
+    figures = build_dashboard_figures(data["version"], data)
+
+    # -------------------------------------------------------------------------
+    # Charts in 2 Columns
+    # -------------------------------------------------------------------------
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.plotly_chart(figures["gauge_steps"], use_container_width=True)
+
+    with col2:
+        st.plotly_chart(figures["gauge_kcal"], use_container_width=True)
         
-        st.header("Image Recognition")
-        
-        # Image uploader for the ticket image
-        uploaded_image = st.file_uploader("Upload your ticket image", type=["jpg", "jpeg", "png"])
-        
-        if uploaded_image is not None:
-            image = Image.open(uploaded_image)
-            # Display image with a fixed width (using 'width' as use_container_width replacement)
-            st.image(image, caption="Your Ticket", width=300)
+    col3, col4 = st.columns(2)
+
+    with col3:
+        st.plotly_chart(figures["pie_chart"], use_container_width=True)
+
+    with col4:
+        st.plotly_chart(figures["bar_sleep"], use_container_width=True)
         
-        # Start analysis on button click
-        if st.button("Analyze 🔎"):
-            st.write("Analyzing your image... ⏳")
-            progress_bar = st.progress(0)
-            for i in range(101):
-                time.sleep(3 / 100)  # Simulate a 3-second progress
-                progress_bar.progress(i)
-            
-            # Predefined list of products from the ticket
-            data = [
-                {"Producto": "Huevo fresco M DO", "Cantidad": 1},
-                {"Producto": "Pizza maxi barbacoa", "Cantidad": 1},
-                {"Producto": "Jamón 250+250", "Cantidad": 1},
-                {"Producto": "Entrecot de añojo", "Cantidad": 1},
-                {"Producto": "Agua Font Vella 1L", "Cantidad": 1},
-                {"Producto": "Aceituna rellena suave", "Cantidad": 1},
-                {"Producto": "Patatas campesinas", "Cantidad": 1},
-                {"Producto": "Aceituna negra", "Cantidad": 2},
-                {"Producto": "Postre leche B. Easo 350g", "Cantidad": 1},
-                {"Producto": "Pan sin corteza Bimbo 610g", "Cantidad": 1},
-                {"Producto": "Leche botella entera Asturiana", "Cantidad": 2},
-                {"Producto": "Torta imperial", "Cantidad": 1},
-                {"Producto": "Turrón duro Calidad Suprema", "Cantidad": 3},
-                {"Producto": "Turrón blando Calidad Suprema", "Cantidad": 3},
-                {"Producto": "Turrón yema tostada", "Cantidad": 1},
-                {"Producto": "Vino tinto crianza C. Colegia", "Cantidad": 1},
-                {"Producto": "Jabón Magno", "Cantidad": 1},
-                {"Producto": "Bolsa Eroski OXO", "Cantidad": 4}
-            ]
-            df = pd.DataFrame(data)
-            # Filter out non-food items (assuming "Jabón Magno" and "Bolsa Eroski OXO" are non-food)
-            food_items = df[~df["Producto"].isin(["Jabón Magno", "Bolsa Eroski OXO"])]
-            
-            st.markdown("### Identified Food Items")
-            # Display a more nicely designed table using st.dataframe
-            st.dataframe(food_items.reset_index(drop=True), width=600, height=300)
-            
-            # Final summary message with fixed text
-            st.markdown("<h3>22 productos added to your pantry 🎉</h3>", unsafe_allow_html=True)
+    # -------------------------------------------------------------------------
+    # Weekly Summary Table (Keep in full width)
+    # -------------------------------------------------------------------------
+    st.markdown("### Weekly Summary")
+    st.dataframe(data["df_week"].style.format({
+        "Steps": "{:,}",
+        "Calories Burned": "{:,}",
+        "Active Minutes": "{:,}",
+        "Sleep Hours": "{:.1f}",
+    }), height=300)
+
+    # -------------------------------------------------------------------------
+    # Weekly Trends in 2-column layout
+    # -------------------------------------------------------------------------
+    st.markdown("#### Trends Over Last 7 Days")
+    trends = figures["trends"]
+
+    for i in range(0, len(trends), 2):
+        c1, c2 = st.columns(2)
+        with c1:
+            st.plotly_chart(trends[i], use_container_width=True)
+        if i + 1 < len(trends):
+            with c2:
+                st.plotly_chart(trends[i + 1], use_container_width=True)
 
 
+# -------------------- Main page --------------------
+def main_page():
+# ------------- aesthetic ---------
+    st.markdown(
+    """
+    <style>
+    @import url('https://fonts.googleapis.com/css2?family=Audrey&family=Poppins&display=swap');
 
-# -------------------- Fitbit Dashboard Tab --------------------
+    html, body, [class*="css"]  {
+        font-family: 'Poppins', 'Audrey', sans-serif;
+    }
+    </style>
+    """,
+    unsafe_allow_html=True
+    )
+    
+    col1,col2,col3=st.columns([2,7,1])
+    with col1:
+        st.image(str(LOGO_IMAGE), width=300)
+    with col2:
+        st.image(str(LOGO_TITLE), width=300)
+    with col3:
+        st.button("Sign out", on_click=sign_out)
+    
+    user_id = st.session_state.get('user_id')
 
+    try:
+        user_id_int = int(user_id)
+    except Exception:
+        st.error("Invalid user_id in session state.")
+        st.session_state['page'] = 'sign_in'
+        return
 
-    with tab5:
-        st.markdown("""
-            <style>
-            @import url('https://fonts.googleapis.com/css2?family=Marmelad&family=ABeeZee:wght@300;400;600&display=swap');
-
-            html, body, [class*="css"] {
-                font-family: 'ABeeZee', sans-serif !important;
-                background-color: #f7f9fc;
-                text-align: center;
-            }
-
-            main {
-                display: flex;
-                flex-direction: column;
-                align-items: center;
-                justify-content: center;
-            }
-
-            h1, h2, h3, h4 {
-                font-family: 'Marmelad', cursive !important;
-                font-weight: 600;
-            }
-            </style>
-            """, unsafe_allow_html=True)
-        
-        st.header("Fitbit Dashboard")
-
-        # -------------------------------------------------------------------------
-        # Display the current day of the week.
-        # -------------------------------------------------------------------------
-        day_of_week = datetime.now().strftime("%A")
-        st.subheader(f"Today is {day_of_week}")
-
-        # -------------------------------------------------------------------------
-        # Fake Data Generation for the Dashboard
-        # -------------------------------------------------------------------------
-        steps = np.random.randint(3000, 15000)
-        steps_target = 10000
-
-        kcal_burned = np.random.randint(1500, 3500)
-        kcal_target = 2500
-
-        times = pd.date_range(start=datetime.now().replace(hour=6, minute=0, second=0, microsecond=0), periods=12, freq='H')
-        heart_rate = np.random.randint(60, 160, size=12)
-        df_hr = pd.DataFrame({"Time": times, "Heart Rate": heart_rate})
-
-        sleep_stages = ["Deep", "Light", "REM", "Awake"]
-        sleep_hours = [np.random.uniform(1, 3), np.random.uniform(2, 4), np.random.uniform(1, 2), np.random.uniform(0.5, 1)]
-        df_sleep = pd.DataFrame({"Stage": sleep_stages, "Hours": np.round(sleep_hours, 1)})
-
-        dates = pd.date_range(end=datetime.now(), periods=7)
-        weekly_steps = [np.random.randint(5000, 12000) for _ in range(7)]
-        weekly_calories = [np.random.randint(2000, 3200) for _ in range(7)]
-        weekly_active = [np.random.randint(30, 120) for _ in range(7)]
-        weekly_sleep = [np.random.uniform(5, 8) for _ in range(7)]
-        weekly_resting_hr = [np.random.randint(55, 75) for _ in range(7)]
-        df_week = pd.DataFrame({
-            "Date": dates,
-            "Steps": weekly_steps,
-            "Calories Burned": weekly_calories,
-            "Active Minutes": weekly_active,
-            "Sleep Hours": weekly_sleep,
-
-        })
-
-        # -------------------------------------------------------------------------
-        # Charts in 2 Columns
-        # -------------------------------------------------------------------------
-        col1, col2 = st.columns(2)
-
-        with col1:
-            gauge_steps = go.Figure(go.Indicator(
-                mode="gauge+number",
-                value=steps,
-                domain={'x': [0, 1], 'y': [0, 1]},
-                title={'text': "Steps Walked"},
-                gauge={
-                    'axis': {'range': [0, 15000]},
-                    'bar': {'color': "#6a5acd"},
-                    'steps': [
-                        {'range': [0, steps_target], 'color': "#dcdcff"},
-                        {'range': [steps_target, 15000], 'color': "#f3f3f3"}
-                    ],
-                }
-            ))
-            gauge_steps.update_layout(height=250, margin={'t': 50, 'b': 0})
-            st.plotly_chart(gauge_steps, use_container_width=True)
-
-        with col2:
-            gauge_kcal = go.Figure(go.Indicator(
-                mode="gauge+number",
-                value=kcal_burned,
-                domain={'x': [0, 1], 'y': [0, 1]},
-                title={'text': "Calories Burned"},
-                gauge={
-                    'axis': {'range': [0, 3500]},
-                    'bar': {'color': "#ff6347"},
-                    'steps': [
-                        {'range': [0, kcal_target], 'color': "#ffe4e1"},
-                        {'range': [kcal_target, 3500], 'color': "#f3f3f3"}
-                    ],
-                }
-            ))
-            gauge_kcal.update_layout(height=250, margin={'t': 50, 'b': 0})
-            st.plotly_chart(gauge_kcal, use_container_width=True)
-            
-        custom_colors = ["#F5A623", "#5C2D91", "#00B8B0"]
-        col3, col4 = st.columns(2)
-
-        with col3:
-            activity_labels = ["Sedentary", "Moderate", "Vigorous"]
-            activity_values = [
-                np.random.randint(300, 900),
-                np.random.randint(200, 600),
-                np.random.randint(100, 300)
-            ]
-
-            pie_chart = px.pie(
-                names=activity_labels,
-                values=activity_values,
-                title="Daily Activity Distribution",
-                color_discrete_sequence=custom_colors
-            )
-            
-            st.plotly_chart(pie_chart, use_container_width=True)
-
-        with col4:
-            bar_sleep = px.bar(
-                df_sleep,
-                x="Stage",
-                y="Hours",
-                title="Sleep Breakdown",
-                text="Hours",
-                color="Stage",
-                color_discrete_sequence=custom_colors
-            )
-            
-            st.plotly_chart(bar_sleep, use_container_width=True)
-            
-        # -------------------------------------------------------------------------
-        # Weekly Summary Table (Keep in full width)
-        # -------------------------------------------------------------------------
-        st.markdown("### Weekly Summary")
-        st.dataframe(df_week.style.format({
-            "Steps": "{:,}",
-            "Calories Burned": "{:,}",
-            "Active Minutes": "{:,}",
-            "Sleep Hours": "{:.1f}",
-        }), height=300)
-
-        # -------------------------------------------------------------------------
-        # Weekly Trends in 2-column layout
-        # -------------------------------------------------------------------------
-        st.markdown("#### Trends Over Last 7 Days")
-        trends = [
-            px.line(df_week, x="Date", y="Steps", title="Steps Trend"),
-            px.line(df_week, x="Date", y="Calories Burned", title="Calories Burned Trend", markers=True),
-            px.line(df_week, x="Date", y="Active Minutes", title="Active Minutes Trend"),
-            px.line(df_week, x="Date", y="Sleep Hours", title="Sleep Hours Trend"),
-        ]
+    # Push writes queued during a Supabase outage (throttled, usually a no-op)
+    replay_pending_writes(get_local_cache(), supabase)
 
-        for i in range(0, len(trends), 2):
-            c1, c2 = st.columns(2)
-            with c1:
-                st.plotly_chart(trends[i], use_container_width=True)
-            if i + 1 < len(trends):
-                with c2:
-                    st.plotly_chart(trends[i + 1], use_container_width=True)
+    # Only the active section runs on a rerun (st.tabs would execute all five bodies)
+    sections = {
+        'Main': main_tab,
+        'Recipes': recipes_tab,
+        'Groceries': groceries_tab,
+        'Image Recognition': image_recognition_tab,
+        'Fitbit App': fitbit_tab,
+    }
+    if st.session_state.get('active_section') not in sections:
+        st.session_state['active_section'] = 'Main'
+    active_section = st.radio("Section", list(sections), key='active_section', horizontal=True, label_visibility="collapsed")
+
+    started = time.perf_counter()
+    try:
+        sections[active_section](user_id)
+    except httpx.TransportError as e:
+        # Unguarded PostgREST calls surface here; reconnect on the next rerun
+        check_supabase_error(supabase, e)
+        raise
+    finally:
+        record_timing(f"rerun_{active_section}", time.perf_counter() - started)
+    render_diagnostics()
 
 
 
@@ -1321,6 +3279,9 @@ def main_page():
 if 'page' not in st.session_state:
     st.session_state['page'] = 'sign_in'
 
+if 'user_id' not in st.session_state:
+    restore_session()
+
 if st.session_state['page'] == 'sign_in':
     sign_in()
 elif st.session_state['page'] == 'create_account':
@@ -0,0 +1,136 @@
+"""Daily calorie and macro targets for arrays of users.
+
+Plain NumPy, no Streamlit: bodari_app wraps these for a single user and the
+nightly recomputation imports this module directly.
+"""
+import time
+
+import numpy as np
+
+# -------------------- Lookup Tables --------------------
+# Mifflin-St Jeor: 10*kg + 6.25*cm - 5*age + s
+GENDER_OFFSETS = {'male': 5.0, 'female': -161.0}
+ACTIVITY_MULTIPLIERS = {
+    'Sedentary': 1.2,
+    'Lightly active': 1.375,
+    'Moderately active': 1.55,
+    'Very active': 1.725,
+    'Super active': 1.9,
+}
+GOAL_ADJUSTMENTS = {'Lose weight': -0.15, 'Maintain weight': 0.0, 'Gain weight': 0.10}
+# (protein, fat, carbs) share of daily calories
+GOAL_MACRO_RATIOS = {
+    'Lose weight': (0.4, 0.3, 0.3),
+    'Maintain weight': (0.25, 0.15, 0.6),
+    'Gain weight': (0.3, 0.2, 0.5),
+}
+KCAL_PER_GRAM = np.array([4.0, 9.0, 4.0])
+CALORIE_MIN = 1200
+CALORIE_MAX = 4000
+
+def lookup(table, keys, default=np.nan):
+    """Maps an array of labels through `table`; labels not in it get `default`.
+
+    One vectorized comparison per table entry, which beats sorting the labels
+    since every table here has a handful of entries.
+    """
+    keys = np.asarray(keys).astype(str)
+    values = np.full(keys.shape, default, dtype=float)
+    for label, value in table.items():
+        values[keys == label] = value
+    return values
+
+def _ratios(goal):
+    goal = np.asarray(goal).astype(str)
+    ratios = np.full(goal.shape + (3,), np.nan)
+    for label, shares in GOAL_MACRO_RATIOS.items():
+        ratios[goal == label] = shares
+    return ratios
+
+# -------------------- Targets --------------------
+def bmr(height, weight, age, gender):
+    """Basal metabolic rate in kcal. Unknown genders get no offset, as in the original formula."""
+    return (10 * np.asarray(weight, dtype=float) + 6.25 * np.asarray(height, dtype=float)
+            - 5.0 * np.asarray(age, dtype=float) + lookup(GENDER_OFFSETS, gender, 0.0))
+
+def tdee(bmr_kcal, activity_level):
+    return np.asarray(bmr_kcal, dtype=float) * lookup(ACTIVITY_MULTIPLIERS, activity_level)
+
+def goal_calories(tdee_kcal, goal):
+    """Rounded daily calories; NaN where the activity level or goal is unknown."""
+    return np.rint(np.asarray(tdee_kcal, dtype=float) * (1 + lookup(GOAL_ADJUSTMENTS, goal)))
+
+def macro_grams(daily_calories, goal):
+    """Returns an (n, 3) array of protein, fat and carb grams."""
+    calories = np.asarray(daily_calories, dtype=float)[..., None]
+    return np.rint(calories * _ratios(goal) / KCAL_PER_GRAM)
+
+def daily_targets(height, weight, age, gender, activity_level, goal):
+    """All targets for aligned arrays of user attributes."""
+    base = bmr(height, weight, age, gender)
+    expenditure = tdee(base, activity_level)
+    calories = goal_calories(expenditure, goal)
+    grams = macro_grams(calories, goal)
+    return {
+        'bmr': base,
+        'tdee': expenditure,
+        'daily_calories': calories,
+        'protein': grams[..., 0],
+        'fat': grams[..., 1],
+        'carbs': grams[..., 2],
+        'out_of_range': (calories < CALORIE_MIN) | (calories > CALORIE_MAX),
+    }
+
+def calorie_warning(daily_calories):
+    """Advice to show next to a single user's target, or None."""
+    if daily_calories < CALORIE_MIN:
+        return f"Your calculated daily calories are below the recommended minimum of {CALORIE_MIN} kcal. Please consult a healthcare provider for personalized advice."
+    if daily_calories > CALORIE_MAX:
+        return f"Your calculated daily calories are above the recommended maximum of {CALORIE_MAX} kcal. Please consult a healthcare provider for personalized advice."
+    return None
+
+# -------------------- Benchmark --------------------
+def random_users(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        'height': rng.uniform(150, 200, n).round(1),
+        'weight': rng.uniform(45, 130, n).round(1),
+        'age': rng.integers(16, 80, n),
+        'gender': rng.choice(['male', 'female', 'other'], n),
+        'activity_level': rng.choice(list(ACTIVITY_MULTIPLIERS), n),
+        'goal': rng.choice(list(GOAL_ADJUSTMENTS), n),
+    }
+
+def scalar_targets(height, weight, age, gender, activity_level, goal):
+    """One user through plain Python, the way the original if/elif formulas did it."""
+    calories = round((10 * weight + 6.25 * height - 5.0 * age + GENDER_OFFSETS.get(gender, 0.0))
+                     * ACTIVITY_MULTIPLIERS[activity_level] * (1 + GOAL_ADJUSTMENTS[goal]))
+    protein, fat, carbs = GOAL_MACRO_RATIOS[goal]
+    return calories, round(calories * protein / 4), round(calories * fat / 9), round(calories * carbs / 4)
+
+def benchmark(n=100_000, seed=0):
+    """Times `daily_targets` against a per-user loop over `scalar_targets` on the same users.
+
+    Returns seconds for each path and whether their results agree.
+    """
+    users = random_users(n, seed)
+    started = time.perf_counter()
+    batch = daily_targets(**users)
+    vector_seconds = time.perf_counter() - started
+
+    columns = [users[k].tolist() for k in ('height', 'weight', 'age', 'gender', 'activity_level', 'goal')]
+    started = time.perf_counter()
+    scalar = [scalar_targets(*user) for user in zip(*columns)]
+    scalar_seconds = time.perf_counter() - started
+
+    expected = np.column_stack([batch[k] for k in ('daily_calories', 'protein', 'fat', 'carbs')])
+    return {
+        'users': n,
+        'scalar_seconds': scalar_seconds,
+        'vector_seconds': vector_seconds,
+        'speedup': scalar_seconds / vector_seconds if vector_seconds else float('inf'),
+        'agree': bool(np.array_equal(expected, np.array(scalar, dtype=float))),
+    }
+
+if __name__ == '__main__':
+    print(benchmark())
@@ -0,0 +1,84 @@
+"""bcrypt hashing for bodari_app, run in worker processes.
+
+bcrypt is CPU-bound (~250 ms at cost 12) and holds the interpreter of whichever
+process runs it, so bodari_app submits these functions to a process pool
+instead of calling bcrypt on the Streamlit script thread. They live outside
+bodari_app because spawned workers import the module a function comes from,
+and importing bodari_app would run the whole page.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+DEFAULT_ROUNDS = 12
+
+def hash_password(password, rounds=DEFAULT_ROUNDS):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def check_password(password, hashed):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    except ValueError:  # not a bcrypt hash
+        return False
+
+def hash_rounds(hashed):
+    """Cost factor stored in a "$2b$12$..." hash, or None if it isn't one."""
+    parts = hashed.split('$')
+    return int(parts[2]) if len(parts) > 3 and parts[2].isdigit() else None
+
+def make_pool(workers=None):
+    """One worker per core. Spawned rather than forked, the Streamlit server is multi-threaded."""
+    workers = workers or os.cpu_count() or 1
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+# -------------------- Load Benchmark --------------------
+def benchmark(logins=200, concurrency=50, rounds=DEFAULT_ROUNDS, workers=None):
+    """Simulates a login spike: `concurrency` sessions each verifying passwords through one pool.
+
+    Returns latency percentiles in milliseconds as seen by a session, queueing included.
+    """
+    hashed = hash_password('correct horse battery staple', rounds)
+    latencies = []
+    lock = threading.Lock()
+    remaining = iter(range(logins))
+
+    with make_pool(workers) as pool:
+        pool.submit(check_password, 'warm up', hashed).result()  # start the workers
+
+        def session():
+            while True:
+                with lock:
+                    if next(remaining, None) is None:
+                        return
+                started = time.perf_counter()
+                pool.submit(check_password, 'correct horse battery staple', hashed).result()
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=session) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    def percentile(p):
+        return round(1000 * latencies[min(len(latencies) - 1, int(p * len(latencies)))], 1)
+    return {
+        'logins': logins,
+        'concurrency': concurrency,
+        'rounds': rounds,
+        'workers': workers or os.cpu_count(),
+        'logins_per_second': round(logins / elapsed, 1),
+        'p50_ms': percentile(0.50),
+        'p99_ms': percentile(0.99),
+    }
+
+if __name__ == '__main__':
+    print(benchmark())
@@ -0,0 +1,83 @@
+"""Times main-page reruns of two versions of bodari_app.py with Streamlit's AppTest.
+
+    python rerun_benchmark.py --user-id 42 --before "$(git merge-base HEAD main)" [--after REV] [--reruns 20]
+
+Compares the main page's rerun time at --before, usually the commit the branch
+forked from, with --after, which defaults to the working tree. Each version is
+copied with the repo's other files into a scratch directory and run headless as
+a signed-in user; the first run warms caches and is not counted. Secrets come
+from .streamlit/secrets.toml, so the reruns hit the same Supabase project the app
+uses.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tomllib
+from pathlib import Path
+
+from streamlit.testing.v1 import AppTest
+
+REPO = Path(__file__).parent
+
+def _checkout(rev, into):
+    for path in REPO.iterdir():
+        if path.suffix in (".py", ".png") or path.name == ".streamlit":
+            copy = shutil.copytree if path.is_dir() else shutil.copy2
+            copy(path, into / path.name)
+    if rev:
+        source = subprocess.run(["git", "show", f"{rev}:bodari_app.py"], cwd=REPO,
+                                check=True, capture_output=True).stdout
+        (into / "bodari_app.py").write_bytes(source)
+
+def time_reruns(rev, user_id, reruns, section=None):
+    """Seconds per rerun of the main page at `rev` (None for the working tree)."""
+    secrets = tomllib.loads((REPO / ".streamlit" / "secrets.toml").read_text())
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        _checkout(rev, Path(scratch))
+        os.chdir(scratch)  # the app resolves its logos relative to the working directory
+        try:
+            at = AppTest.from_file(str(Path(scratch) / "bodari_app.py"), default_timeout=120)
+            for key, value in secrets.items():
+                at.secrets[key] = value
+            at.session_state["user_id"] = user_id
+            at.session_state["page"] = "main"
+            if section:
+                at.session_state["active_section"] = section
+            at.run()
+            samples = []
+            for _ in range(reruns):
+                started = time.perf_counter()
+                at.run()
+                samples.append(time.perf_counter() - started)
+                if at.exception:
+                    raise RuntimeError(f"{rev or 'working tree'} raised: {at.exception[0].message}")
+            return samples
+        finally:
+            os.chdir(cwd)
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        "median_ms": round(1000 * statistics.median(ordered), 1),
+        "p95_ms": round(1000 * ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 1),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--user-id", type=int, required=True, help="an onboarded account in the configured project")
+    parser.add_argument("--before", required=True, help="revision to compare against, e.g. the merge-base with main")
+    parser.add_argument("--after", default=None)
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--section", default="Main", help="section to show, for versions that render one at a time")
+    args = parser.parse_args()
+
+    before = summarize(time_reruns(args.before, args.user_id, args.reruns, args.section))
+    after = summarize(time_reruns(args.after, args.user_id, args.reruns, args.section))
+    print(f"before ({args.before}): {before}")
+    print(f"after ({args.after or 'working tree'}): {after}")
+    print(f"median speedup: {before['median_ms'] / after['median_ms']:.1f}x")